@@ -1,6 +1,8 @@
 from benchmark_flow import benchmark_backfill_flow, benchmark_daily_flow
 from betas_flow import betas_backfill_flow, betas_daily_flow
 from calendar_flow import calendar_backfill_flow
+from clients import get_bear_lake_stats, get_table_cache_stats
+from compaction_flow import compaction_flow
 from etf_prices_flow import etf_prices_backfill_flow, etf_prices_daily_flow
 from factor_covariances_flow import (factor_covariances_backfill_flow,
                                      factor_covariances_daily_flow)
@@ -11,44 +13,63 @@ from portfolio_history_flow import portfolio_history_daily_flow
 from portfolio_weights_flow import portfolio_weights_daily_flow
 from prefect import flow, serve
 from prefect.schedules import Cron
-from returns_flow import returns_backfill_flow
-from reversal_flow import reversal_backfill_flow, reversal_daily_flow
+from returns_flow import returns_backfill_flow, returns_daily_flow
+from signals_flow import signals_backfill_flow, signals_daily_flow
 from stock_prices_flow import (stock_prices_backfill_flow,
                                stock_prices_daily_flow)
 from universe_flow import universe_backfill_flow
+from utils import dataset_scope, get_dataset_stats
+from utils.dag import run_stages
 from utils.slack_failure_handler import create_failure_handler
 
+DAILY_STAGES = {
+    "calendar": (calendar_backfill_flow, []),
+    "universe": (universe_backfill_flow, []),
+    "stock_prices": (stock_prices_daily_flow, ["calendar", "universe"]),
+    "etf_prices": (etf_prices_daily_flow, ["calendar"]),
+    "returns": (returns_daily_flow, ["stock_prices", "etf_prices"]),
+    "factor_model": (factor_model_daily_flow, ["returns"]),
+    "factor_covariances": (factor_covariances_daily_flow, ["returns"]),
+    "signals": (signals_daily_flow, ["returns", "factor_model"]),
+    "benchmark": (benchmark_daily_flow, ["returns"]),
+    "betas": (betas_daily_flow, ["returns", "benchmark"]),
+    "portfolio_weights": (
+        portfolio_weights_daily_flow,
+        ["factor_model", "factor_covariances", "signals", "benchmark", "betas"],
+    ),
+    "portfolio_history": (portfolio_history_daily_flow, ["calendar"]),
+    "etf_history": (etf_history_daily_flow, ["calendar"]),
+    "stock_history": (stock_history_daily_flow, ["calendar", "universe"]),
+}
+
 
 @flow(on_failure=[create_failure_handler("daily_flow")])
 def daily_flow():
-    calendar_backfill_flow()
-    universe_backfill_flow()  # Depends on calendar
-    stock_prices_daily_flow()  # Depends on universe
-    etf_prices_daily_flow()  # Depends on calendar
-    returns_backfill_flow()  # Depends on stock_prices and etf_prices
-    factor_model_daily_flow()  # Depends on stock_returns and etf_returns
-    factor_covariances_daily_flow()  # Depends on etf_returns
-    reversal_daily_flow()  # Depends on stock_returns and factor_model
-    benchmark_daily_flow()  # Depends on stock_returns
-    betas_daily_flow()  # Depends on stock_returns and benchmark_returns
-    portfolio_weights_daily_flow()  # Depends on everything
-    portfolio_history_daily_flow()
-    etf_history_daily_flow()
-    stock_history_daily_flow()
+    # Independent branches run concurrently, so the run takes as long as the
+    # critical path rather than the sum of all stages. Frames published by a
+    # stage are read from memory by its dependents and dropped after the run.
+    with dataset_scope():
+        run_stages(DAILY_STAGES)
+    compaction_flow()  # Depends on every flow that appended
+
+    print("Datasets:", get_dataset_stats())
+    print("Bear Lake client:", get_bear_lake_stats())
+    print("Bear Lake cache:", get_table_cache_stats())
 
 
 @flow
 def backfill_flow():
     calendar_backfill_flow()
-    universe_backfill_flow()  # Depends on calendar
-    stock_prices_backfill_flow()  # Depends on universe
+    universe_backfill_flow(full_refresh=True)
+    stock_prices_backfill_flow()  # Depends on calendar and universe
     etf_prices_backfill_flow()  # Depends on calendar
     returns_backfill_flow()  # Depends on stock_prices and etf_prices
     factor_model_backfill_flow()  # Depends on stock_returns and etf_returns
     factor_covariances_backfill_flow()  # Depends on etf_returns
-    reversal_backfill_flow()  # Depends on stock_returns and factor_model
+    signals_backfill_flow()  # Depends on stock_returns and factor_model
     benchmark_backfill_flow()  # Depends on stock_returns
     betas_backfill_flow()  # Depends on stock_returns and benchmark_returns
+    compaction_flow()  # Depends on every flow that appended
 
 
 if __name__ == "__main__":
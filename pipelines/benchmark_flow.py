@@ -3,33 +3,50 @@ import datetime as dt
 import polars as pl
 from clients import get_bear_lake_client
 from prefect import flow, task
-from utils import get_last_market_date, get_universe_returns
-from variables import TIME_ZONE
+from utils import get_last_market_date, scan_benchmark_weights, scan_table
+from variables import BENCHMARK, CACHE_BENCHMARK_WEIGHTS, TIME_ZONE
+
+
+def scan_benchmark(start: dt.date, end: dt.date) -> pl.LazyFrame:
+    # Weights evaluated from the benchmark's rule, with the returns of its members
+    return scan_benchmark_weights(start, end, BENCHMARK).join(
+        other=scan_table("stock_returns", start, end, ["date", "ticker", "return"]),
+        on=["date", "ticker"],
+        how="left",
+    )
 
 
 @task
-def calculate_benchmark_weights(universe_returns: pl.DataFrame) -> pl.DataFrame:
-    return universe_returns.select(
+def calculate_benchmark(
+    start: dt.date, end: dt.date
+) -> tuple[pl.DataFrame | None, pl.DataFrame]:
+    bear_lake_client = get_bear_lake_client()
+    benchmark = scan_benchmark(start, end)
+
+    benchmark_returns = (
+        benchmark.group_by("date")
+        .agg(pl.col("return").mul(pl.col("weight")).sum())
+        .sort("date")
+    )
+
+    # Readers evaluate the weights themselves unless they are cached
+    if not CACHE_BENCHMARK_WEIGHTS:
+        return None, bear_lake_client.query(benchmark_returns)
+
+    benchmark_weights = benchmark.select(
         "ticker",
         "date",
         pl.col("date").dt.year().alias("year"),
-        pl.lit(1).truediv(pl.len()).over("date").alias("weight"),
+        "weight",
     ).sort("ticker", "date")
 
-
-@task
-def calculate_benchmark_returns(
-    universe_returns: pl.DataFrame, benchmark_weights: pl.DataFrame
-) -> pl.DataFrame:
-    return (
-        benchmark_weights.join(
-            other=universe_returns, on=["date", "ticker"], how="left"
-        )
-        .group_by("date")
-        .agg(pl.col("return").mul(pl.col("weight")).sum())
-        .sort("date")
+    # Both from the same scan of the universe and returns
+    benchmark_weights, benchmark_returns = bear_lake_client.collect_all(
+        [benchmark_weights, benchmark_returns]
     )
 
+    return benchmark_weights, benchmark_returns
+
 
 @task
 def upload_and_merge_benchmark_weights(benchmark_weights: pl.DataFrame) -> pl.DataFrame:
@@ -51,10 +68,7 @@ def upload_and_merge_benchmark_weights(benchmark_weights: pl.DataFrame) -> pl.Da
     )
 
     # Insert
-    bear_lake_client.insert(name=table_name, data=benchmark_weights, mode="append")
-
-    # Optimize table (deduplicate)
-    bear_lake_client.optimize(name=table_name)
+    bear_lake_client.upsert(name=table_name, data=benchmark_weights)
 
 
 @task
@@ -72,10 +86,7 @@ def upload_and_merge_benchmark_returns(benchmark_returns: pl.DataFrame) -> pl.Da
     )
 
     # Insert
-    bear_lake_client.insert(name=table_name, data=benchmark_returns, mode="append")
-
-    # Optimize table (deduplicate)
-    bear_lake_client.optimize(name=table_name)
+    bear_lake_client.upsert(name=table_name, data=benchmark_returns)
 
 
 @flow
@@ -83,12 +94,10 @@ def benchmark_backfill_flow():
     start = dt.date(2020, 7, 28)
     end = dt.date.today() - dt.timedelta(days=1)
 
-    universe_returns = get_universe_returns(start, end)
+    benchmark_weights, benchmark_returns = calculate_benchmark(start, end)
 
-    benchmark_weights = calculate_benchmark_weights(universe_returns)
-    benchmark_returns = calculate_benchmark_returns(universe_returns, benchmark_weights)
-
-    upload_and_merge_benchmark_weights(benchmark_weights)
+    if benchmark_weights is not None:
+        upload_and_merge_benchmark_weights(benchmark_weights)
     upload_and_merge_benchmark_returns(benchmark_returns)
 
 
@@ -104,10 +113,8 @@ def benchmark_daily_flow():
         print("Yesterday:", yesterday)
         return
 
-    universe_returns = get_universe_returns(yesterday, yesterday)
-
-    benchmark_weights = calculate_benchmark_weights(universe_returns)
-    benchmark_returns = calculate_benchmark_returns(universe_returns, benchmark_weights)
+    benchmark_weights, benchmark_returns = calculate_benchmark(yesterday, yesterday)
 
-    upload_and_merge_benchmark_weights(benchmark_weights)
+    if benchmark_weights is not None:
+        upload_and_merge_benchmark_weights(benchmark_weights)
     upload_and_merge_benchmark_returns(benchmark_returns)
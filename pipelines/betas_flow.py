@@ -1,76 +1,120 @@
 import datetime as dt
 
+import bear_lake as bl
 import polars as pl
-import statsmodels.api as sm
 from clients import get_bear_lake_client
 from prefect import flow, task
-from statsmodels.regression.rolling import RollingOLS
-from tqdm import tqdm
-from utils import (get_benchmark_returns, get_stock_returns,
-                   get_trading_date_range)
-from variables import DISABLE_TQDM, WINDOW
+from utils import (build_operator_state, check_operator_state,
+                   get_benchmark_returns, get_last_market_date,
+                   get_operator_state, get_stock_returns,
+                   get_trading_date_range, get_trading_days_since,
+                   update_operator_state, upload_operator_state)
+from variables import WINDOW
+
+# Smoothing of the historical betas into predicted betas, see clean_betas
+BETAS_OPERATORS = {"half_life": 60}
 
 
 @task
 def estimate_regression(
     stock_returns: pl.DataFrame, benchmark_returns: pl.DataFrame
 ) -> pl.DataFrame:
-    df = stock_returns.join(
-        other=benchmark_returns.rename({"return": "benchmark_return"}),
-        how="left",
-        on="date",
-    )
+    # Days missing either return are dropped from the window, like RollingOLS does
+    observed = pl.col("return").is_not_null() & pl.col("benchmark_return").is_not_null()
+    x = pl.when(observed).then(pl.col("benchmark_return")).otherwise(0.0)
+    y = pl.when(observed).then(pl.col("return")).otherwise(0.0)
 
-    results = []
-    for ticker in tqdm(
-        df["ticker"].unique(), desc="Estimating benchmark betas", disable=DISABLE_TQDM
-    ):
-        ticker_df = df.filter(pl.col("ticker") == ticker).sort("date")
-
-        if len(ticker_df) < WINDOW:
-            continue
-
-        y = ticker_df["return"].to_pandas()
-        X = sm.add_constant(ticker_df.select("benchmark_return").to_pandas())
-
-        rolling_model = RollingOLS(y, X, window=WINDOW).fit()
-
-        result = pl.DataFrame(
-            {
-                "ticker": ticker,
-                "date": ticker_df["date"],
-                "return": ticker_df["return"],
-                "alpha": rolling_model.params["const"],
-                "benchmark_return": ticker_df["benchmark_return"],
-                "beta": rolling_model.params["benchmark_return"],
-            }
-        )
-        results.append(result)
+    def rolling_sum(expr: pl.Expr) -> pl.Expr:
+        return expr.rolling_sum(window_size=WINDOW).over("ticker")
+
+    n = pl.col("n")
+    mean_x = pl.col("sum_x") / n
+    mean_y = pl.col("sum_y") / n
 
-    results = pl.concat(results).with_columns(
-        pl.col("return")
-        .sub(pl.col("alpha") + pl.col("beta").mul(pl.col("benchmark_return")))
-        .alias("residual")
+    return (
+        stock_returns.lazy()
+        .join(
+            other=benchmark_returns.lazy().rename({"return": "benchmark_return"}),
+            how="left",
+            on="date",
+        )
+        .sort("ticker", "date")
+        .with_columns(
+            rolling_sum(observed.cast(pl.Float64)).alias("n"),
+            rolling_sum(x).alias("sum_x"),
+            rolling_sum(y).alias("sum_y"),
+            rolling_sum(x * x).alias("sum_xx"),
+            rolling_sum(x * y).alias("sum_xy"),
+        )
+        .with_columns(
+            (pl.col("sum_xy") / n - mean_x * mean_y).alias("covariance"),
+            (pl.col("sum_xx") / n - mean_x * mean_x).alias("variance"),
+        )
+        .with_columns(
+            pl.when(n >= 2, pl.col("variance") != 0)
+            .then(pl.col("covariance") / pl.col("variance"))
+            .alias("beta")
+        )
+        .with_columns((mean_y - pl.col("beta") * mean_x).alias("alpha"))
+        .with_columns(
+            pl.col("return")
+            .sub(pl.col("alpha") + pl.col("beta").mul(pl.col("benchmark_return")))
+            .alias("residual")
+        )
+        .select("ticker", "date", "alpha", "beta", "residual")
+        .collect()
     )
 
-    return results.select("ticker", "date", "beta")
+
+def get_historical_betas(betas: pl.DataFrame) -> pl.DataFrame:
+    return (
+        betas.drop_nulls("beta")
+        .sort("ticker", "date")
+        .select("ticker", "date", pl.col("beta").alias("historical_beta"), "beta")
+    )
 
 
 @task
 def clean_betas(betas: pl.DataFrame) -> pl.DataFrame:
-    return (
-        betas.drop_nulls()
-        .sort("ticker", "date")
-        .select(
-            "ticker",
-            "date",
-            pl.col("date").dt.year().alias("year"),
-            pl.col("beta").alias("historical_beta"),
-            pl.col("beta")
-            .ewm_mean(half_life=60)
-            .over("ticker")
-            .alias("predicted_beta"),
-        )
+    return get_historical_betas(betas).select(
+        "ticker",
+        "date",
+        pl.col("date").dt.year().alias("year"),
+        "historical_beta",
+        pl.col("beta")
+        .ewm_mean(half_life=BETAS_OPERATORS["half_life"])
+        .over("ticker")
+        .alias("predicted_beta"),
+    )
+
+
+@task
+def build_smoothing_state(betas: pl.DataFrame):
+    # Full rebuild over the whole history, which is what the backfill smooths
+    state, _ = build_operator_state(
+        get_historical_betas(betas), keys=["ticker"], value="beta", **BETAS_OPERATORS
+    )
+    upload_operator_state("betas", state)
+
+
+@task
+def update_smoothing_state(
+    state: pl.DataFrame, betas: pl.DataFrame
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    # Smooth only the new historical betas, carrying each EWM from its state
+    state, betas = update_operator_state(
+        state,
+        get_historical_betas(betas),
+        keys=["ticker"],
+        value="beta",
+        **BETAS_OPERATORS,
+    )
+    return state, betas.select(
+        "ticker",
+        "date",
+        pl.col("date").dt.year().alias("year"),
+        "historical_beta",
+        pl.col("beta").alias("predicted_beta"),
     )
 
 
@@ -94,11 +138,8 @@ def upload_and_merge_betas(betas: pl.DataFrame) -> pl.DataFrame:
         mode="skip",
     )
 
-    # Insert data
-    bear_lake_client.insert(name=table_name, data=betas, mode="append")
-
-    # Optimize
-    bear_lake_client.optimize(name=table_name)
+    # Upsert data
+    bear_lake_client.upsert(name=table_name, data=betas)
 
 
 @flow
@@ -114,29 +155,74 @@ def betas_backfill_flow():
     betas = clean_betas(betas_raw)
 
     upload_and_merge_betas(betas)
+    build_smoothing_state(betas_raw)
 
 
 @flow
-def betas_daily_flow():
-    date_range = get_trading_date_range(window=WINDOW * 2)
+def betas_smoothing_check_flow():
+    # EWMs depend on the whole history, so this has to redo the full backfill
+    start = dt.date(2020, 7, 28)
+    end = dt.date.today() - dt.timedelta(days=1)
 
-    start = date_range["date"].min()
-    end = date_range["date"].max()
+    stock_returns = get_stock_returns(start, end)
+    benchmark_returns = get_benchmark_returns(start, end)
+
+    betas_raw = estimate_regression(stock_returns, benchmark_returns)
 
+    # Also diff the outputs the daily updates wrote over the last window
+    bear_lake_client = get_bear_lake_client()
+    since = get_trading_date_range(window=WINDOW)["date"].min()
+    betas = bear_lake_client.query(bl.table("betas").filter(pl.col("date") >= since))
+
+    check_operator_state(
+        get_operator_state("betas"),
+        get_historical_betas(betas_raw),
+        keys=["ticker"],
+        value="beta",
+        outputs=betas.select("ticker", "date", pl.col("predicted_beta").alias("beta")),
+        **BETAS_OPERATORS,
+    )
+
+
+@flow
+def betas_daily_flow():
+    last_market_date = get_last_market_date()
     yesterday = dt.date.today() - dt.timedelta(days=1)
 
     # Only get new data if yesterday was the last market date
-    if end != yesterday:
+    if last_market_date != yesterday:
         print("Market was not open yesterday!")
-        print("Last Market Date:", end)
+        print("Last Market Date:", last_market_date)
         print("Yesterday:", yesterday)
         return
 
+    state = get_operator_state("betas")
+    watermark = state["date"].max()
+
+    if watermark is None:
+        raise ValueError("Betas state is empty! Run betas_backfill_flow.")
+
+    if watermark >= last_market_date:
+        print("Betas state is already up to date!")
+        print("State Date:", watermark)
+        return
+
+    # One window of returns for every date since the state was last updated, so
+    # days the flow missed are caught up rather than skipped by the EWMs
+    missed_days = get_trading_days_since(watermark)
+    date_range = get_trading_date_range(window=WINDOW + missed_days - 1)
+
+    start = date_range["date"].min()
+    end = date_range["date"].max()
+
     stock_returns = get_stock_returns(start, end)
     benchmark_returns = get_benchmark_returns(start, end)
 
     betas_raw = estimate_regression(stock_returns, benchmark_returns)
 
-    betas = clean_betas(betas_raw).filter(pl.col("date").eq(end))
+    # Dates already in the state are skipped
+    state, betas = update_smoothing_state(state, betas_raw)
 
+    # Outputs first, so a failure before the state is saved just redoes the day
     upload_and_merge_betas(betas)
+    upload_operator_state("betas", state)
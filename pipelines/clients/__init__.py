@@ -1,11 +1,14 @@
 from .alpaca import (get_alpaca_historical_stock_data_client,
                      get_alpaca_trading_client)
-from .bear_lake import get_bear_lake_client
+from .bear_lake import get_bear_lake_client, get_bear_lake_stats
 from .slack import get_slack_client
+from .table_cache import get_table_cache_stats
 
 __all__ = [
     "get_alpaca_historical_stock_data_client",
     "get_alpaca_trading_client",
     "get_bear_lake_client",
+    "get_bear_lake_stats",
     "get_slack_client",
+    "get_table_cache_stats",
 ]
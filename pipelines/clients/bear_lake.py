@@ -1,8 +1,14 @@
 import os
+import threading
 
 import bear_lake as bl
+import numpy as np
+import polars as pl
 from dotenv import load_dotenv
 
+from .table_cache import (cache_max_bytes, get_cached_files, get_file_info,
+                          get_partition, unpin)
+
 load_dotenv(override=True)
 
 access_key_id = os.getenv("ACCESS_KEY_ID")
@@ -21,6 +27,410 @@ storage_options = {
 
 url = f"s3://{bucket}"
 
+stats = {
+    "connections_opened": 0,
+    "metadata_fetches": 0,
+    "metadata_fetches_avoided": 0,
+}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class PooledDatabase(bl.Database):
+    """
+    A Database shared by every caller in the process. Table metadata, the table
+    list and each table's file manifest are cached in memory and invalidated
+    whenever this process writes to the table.
+    """
+
+    def __init__(self, database: bl.Database):
+        super().__init__(
+            database.path, database.file_system_client, database.storage_options
+        )
+        self._lock = threading.RLock()
+        self._metadata = {}
+        self._manifests = {}
+        self._tables = None
+        self._touched = set()
+        # Cached files pinned by the scans this thread built but hasn't collected
+        self._pinned = threading.local()
+
+    def _cached(self, cache: dict, key: str, fetch):
+        with self._lock:
+            if key in cache:
+                stats["metadata_fetches_avoided"] += 1
+                return cache[key]
+
+        value = fetch()
+
+        with self._lock:
+            stats["metadata_fetches"] += 1
+            cache[key] = value
+
+        return value
+
+    def invalidate(self, name: str | None = None):
+        with self._lock:
+            if name is None:
+                self._metadata.clear()
+                self._manifests.clear()
+            else:
+                self._metadata.pop(name, None)
+                self._manifests.pop(name, None)
+            self._tables = None
+
+    def _read_metadata(self, name: str) -> dict:
+        return self._cached(
+            self._metadata,
+            name,
+            lambda: super(PooledDatabase, self)._read_metadata(name),
+        )
+
+    def list_tables(self) -> list[str]:
+        with self._lock:
+            if self._tables is not None:
+                stats["metadata_fetches_avoided"] += 1
+                return list(self._tables)
+
+        tables = super().list_tables()
+
+        with self._lock:
+            stats["metadata_fetches"] += 1
+            self._tables = tables
+
+        return list(tables)
+
+    def list_files(self, name: str) -> list[str]:
+        """Parquet files of a table, cached until this process writes to it."""
+        table_path = self._get_table_path(name)
+        return list(
+            self._cached(
+                self._manifests,
+                name,
+                lambda: sorted(
+                    self.file_system_client.glob(f"{table_path}/**/*.parquet")
+                ),
+            )
+        )
+
+    def get_partition_files(
+        self, name: str, partitions: list[str] | None = None
+    ) -> list[str]:
+        table_path = self._get_table_path(name)
+        return [
+            path
+            for path in self.list_files(name)
+            if partitions is None or get_partition(table_path, path) in partitions
+        ]
+
+    def get_scan_plan(
+        self, name: str, partitions: list[str] | None = None
+    ) -> pl.DataFrame:
+        """Partitions and bytes a scan of the table would read."""
+        table_path = self._get_table_path(name)
+        return pl.DataFrame(
+            [
+                {
+                    "table": name,
+                    "partition": get_partition(table_path, path),
+                    "bytes": size,
+                }
+                for path, (_, size) in sorted(get_file_info(self, name).items())
+                if partitions is None or get_partition(table_path, path) in partitions
+            ],
+            schema={"table": pl.String, "partition": pl.String, "bytes": pl.Int64},
+        )
+
+    def table(self, name: str, partitions: list[str] | None = None) -> pl.LazyFrame:
+        """
+        Scan a table (or only the given partitions). With the local
+        read-through cache enabled, partitions that haven't changed remotely are
+        read from local disk, and stay pinned until this thread's next query or
+        collect_all.
+        """
+        if not cache_max_bytes > 0:
+            if partitions is None:
+                return bl.table(name)
+
+            paths = self.get_partition_files(name, partitions)
+            storage_options = self.storage_options
+        else:
+            paths = get_cached_files(self, name, partitions)
+            storage_options = None
+            self._pinned.paths = getattr(self._pinned, "paths", []) + paths
+
+        # Nothing to prune to, fall back to the full table so the schema is kept
+        if not len(paths) > 0:
+            return bl.table(name).head(0) if partitions is not None else bl.table(name)
+
+        return pl.scan_parquet(paths, storage_options=storage_options)
+
+    def _unpin(self):
+        paths = getattr(self._pinned, "paths", [])
+        self._pinned.paths = []
+        unpin(paths)
+
+    def query(self, expression: pl.LazyFrame) -> pl.DataFrame:
+        try:
+            return super().query(expression)
+        finally:
+            self._unpin()
+
+    def collect_all(self, expressions: list[pl.LazyFrame]) -> list[pl.DataFrame]:
+        # Several scans collected at once, sharing their common subplans
+        try:
+            return pl.collect_all(expressions)
+        finally:
+            self._unpin()
+
+    def create(
+        self,
+        name: str,
+        schema: dict,
+        partition_keys: list[str] | None,
+        primary_keys: list[str],
+        mode: str = "error",
+    ) -> None:
+        # A cached metadata entry means the table exists, so skip the round trip
+        with self._lock:
+            if mode == "skip" and name in self._metadata:
+                stats["metadata_fetches_avoided"] += 1
+                return
+
+        try:
+            super().create(name, schema, partition_keys, primary_keys, mode)
+        finally:
+            self.invalidate(name)
+
+    def insert(self, name: str, data, mode: str = "append"):
+        touched = {(name, partition) for partition in self.get_partitions(name, data)}
+
+        try:
+            super().insert(name, data, mode)
+        finally:
+            with self._lock:
+                self._manifests.pop(name, None)
+                self._touched |= touched
+
+    def _handle_existing_file(self, parquet_file: str, data, mode: str):
+        data = super()._handle_existing_file(parquet_file, data, mode)
+
+        if mode != "append":
+            return data
+
+        # An append already rewrites the whole file, so replaced keys are dropped
+        # here for free instead of waiting for a compaction to deduplicate them
+        name = parquet_file.removeprefix(f"{self.path}/").split("/")[0]
+        primary_keys = self._read_metadata(name)["primary_keys"]
+
+        if not primary_keys:
+            return data
+
+        return data.unique(subset=primary_keys, keep="last", maintain_order=True)
+
+    def upsert(self, name: str, data: pl.DataFrame) -> pl.DataFrame:
+        """
+        Merge data into a table on its primary keys, replacing stored rows with
+        the same keys. Only partition files that receive new or changed rows are
+        rewritten: a partition whose incoming row checksums all match stored rows
+        is skipped without a write. Returns what happened to each partition.
+        """
+        metadata = self._read_metadata(name)
+        primary_keys = metadata["primary_keys"]
+        partition_keys = metadata["partition_keys"]
+        table_path = self._get_table_path(name)
+
+        data = data.unique(subset=primary_keys, keep="last", maintain_order=True)
+
+        if partition_keys:
+            groups = data.group_by(partition_keys)
+        else:
+            self.file_system_client.makedirs(table_path)
+            groups = [(None, data)]
+
+        report = []
+        for p_values, group in groups:
+            if p_values is None:
+                partition = name
+                file_path = f"{table_path}/{name}.parquet"
+            else:
+                partition = "/".join(str(value) for value in p_values)
+                file_path = self._build_partition_path(table_path, p_values)
+
+            changed_rows = len(group)
+            if self.file_system_client.exists(file_path):
+                existing = pl.read_parquet(
+                    file_path, storage_options=self.storage_options
+                )
+
+                # Row checksums find the incoming rows that aren't stored verbatim
+                changed_rows = (
+                    ~group.hash_rows().is_in(existing.select(group.columns).hash_rows())
+                ).sum()
+
+                if changed_rows > 0:
+                    group = pl.concat(
+                        [
+                            existing.join(
+                                group.select(primary_keys), on=primary_keys, how="anti"
+                            ),
+                            group,
+                        ]
+                    )
+
+            if changed_rows > 0:
+                group.write_parquet(file_path, storage_options=self.storage_options)
+
+                with self._lock:
+                    self._manifests.pop(name, None)
+                    self._touched.add((name, partition))
+
+            report.append(
+                {
+                    "table": name,
+                    "partition": partition,
+                    "changed_rows": changed_rows,
+                    "written": changed_rows > 0,
+                }
+            )
+
+        return pl.DataFrame(
+            report,
+            schema={
+                "table": pl.String,
+                "partition": pl.String,
+                "changed_rows": pl.Int64,
+                "written": pl.Boolean,
+            },
+        )
+
+    def get_partitions(self, name: str, data: pl.DataFrame) -> list[str]:
+        """Partitions (as in get_partition) that rows of data belong to."""
+        partition_keys = self._read_metadata(name)["partition_keys"]
+
+        if not partition_keys:
+            return [name]
+
+        return [
+            "/".join(str(value) for value in values)
+            for values in data.select(partition_keys).unique().rows()
+        ]
+
+    def get_unsorted_rows(self, name: str, partition: str) -> tuple[int, int]:
+        """Rows of a partition past its primary key sorted prefix, and all rows."""
+        primary_keys = self._read_metadata(name)["primary_keys"]
+        keys = pl.read_parquet(
+            f"{self._get_table_path(name)}/{partition}.parquet",
+            columns=primary_keys,
+            storage_options=self.storage_options,
+        )
+
+        order = (
+            keys.with_row_index().sort(primary_keys, maintain_order=True)["index"]
+        ).to_numpy()
+        out_of_order = np.flatnonzero(order != np.arange(len(order)))
+        sorted_rows = out_of_order[0] if len(out_of_order) > 0 else len(order)
+
+        return len(order) - sorted_rows, len(order)
+
+    def compact_partition(self, name: str, partition: str):
+        primary_keys = self._read_metadata(name)["primary_keys"]
+        file_path = f"{self._get_table_path(name)}/{partition}.parquet"
+
+        df = pl.read_parquet(file_path, storage_options=self.storage_options)
+        if primary_keys:
+            df = df.unique(subset=primary_keys, keep="last").sort(primary_keys)
+
+        df.write_parquet(file_path, storage_options=self.storage_options)
+
+        with self._lock:
+            self._manifests.pop(name, None)
+
+    def compact(
+        self, min_unsorted_rows: int, min_unsorted_fraction: float
+    ) -> pl.DataFrame:
+        """
+        Compact the partitions this process appended to since the last call,
+        once each. Appends never leave duplicate keys behind, so a partition is
+        only rewritten (sorted) when at least min_unsorted_rows or
+        min_unsorted_fraction of its rows are out of primary key order.
+        """
+        with self._lock:
+            touched = sorted(self._touched)
+            self._touched = set()
+
+        report = []
+        for name, partition in touched:
+            file_path = f"{self._get_table_path(name)}/{partition}.parquet"
+            if not self.file_system_client.exists(file_path):
+                continue
+
+            unsorted_rows, rows = self.get_unsorted_rows(name, partition)
+            compacted = unsorted_rows > 0 and (
+                unsorted_rows >= min_unsorted_rows
+                or unsorted_rows >= min_unsorted_fraction * rows
+            )
+
+            if compacted:
+                self.compact_partition(name, partition)
+
+            report.append(
+                {
+                    "table": name,
+                    "partition": partition,
+                    "rows": rows,
+                    "unsorted_rows": unsorted_rows,
+                    "compacted": compacted,
+                }
+            )
+
+        return pl.DataFrame(
+            report,
+            schema={
+                "table": pl.String,
+                "partition": pl.String,
+                "rows": pl.Int64,
+                "unsorted_rows": pl.Int64,
+                "compacted": pl.Boolean,
+            },
+        )
+
+    def delete(self, name: str, expression):
+        try:
+            super().delete(name, expression)
+        finally:
+            with self._lock:
+                self._manifests.pop(name, None)
+
+    def optimize(self, name: str) -> None:
+        try:
+            super().optimize(name)
+        finally:
+            with self._lock:
+                self._manifests.pop(name, None)
+
+    def drop(self, name: str):
+        try:
+            super().drop(name)
+        finally:
+            self.invalidate(name)
+
+
+def get_bear_lake_client() -> PooledDatabase:
+    global _client
+
+    # Every task in the process shares one connection and its metadata cache
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PooledDatabase(
+                    bl.connect_s3(path=url, storage_options=storage_options)
+                )
+                stats["connections_opened"] += 1
+
+    return _client
+
 
-def get_bear_lake_client() -> bl.Database:
-    return bl.connect_s3(path=url, storage_options=storage_options)
+def get_bear_lake_stats() -> dict[str, int]:
+    return dict(stats)
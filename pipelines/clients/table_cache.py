@@ -0,0 +1,195 @@
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from collections import Counter
+
+import bear_lake as bl
+
+cache_dir = os.path.expanduser(
+    os.getenv("BEAR_LAKE_CACHE_DIR", "~/.cache/portfolio-pipelines/bear_lake")
+)
+# Off unless given a budget. Whole files are downloaded, which bypasses column
+# projection and row group pruning, so it only pays off on a persistent disk.
+cache_max_bytes = int(os.getenv("BEAR_LAKE_CACHE_MAX_BYTES") or 0)
+
+stats = {
+    "cache_hits": 0,
+    "cache_misses": 0,
+    "cache_evictions": 0,
+}
+
+_lock = threading.Lock()
+
+# Cached files handed to scans that haven't been collected yet, with the number
+# of scans holding each. Eviction never removes a pinned file.
+_pins: Counter[str] = Counter()
+
+
+def get_file_info(database: bl.Database, name: str) -> dict[str, tuple[str, int]]:
+    """
+    Current version and size of every parquet file of a table, read from the
+    remote listing. The version is the ETag on S3 and the modification time and
+    size on local disk.
+    """
+    table_path = database._get_table_path(name)
+    fs = getattr(database.file_system_client, "fs", None)
+
+    if fs is None:
+        file_info = {}
+        for path in database.file_system_client.glob(f"{table_path}/**/*.parquet"):
+            stat = os.stat(path)
+            file_info[path] = (f"{stat.st_mtime_ns}-{stat.st_size}", stat.st_size)
+        return file_info
+
+    # One recursive listing returns the ETag of every file in the table
+    files = fs.find(table_path.replace("s3://", ""), detail=True)
+    return {
+        f"s3://{path}": (
+            info.get("ETag") or f"{info.get('LastModified')}-{info['size']}",
+            info["size"],
+        )
+        for path, info in files.items()
+        if path.endswith(".parquet")
+    }
+
+
+def get_partition(table_path: str, path: str) -> str:
+    # Partition files are <table>/<value>[/<value>...].parquet
+    return path.removeprefix(f"{table_path}/").removesuffix(".parquet")
+
+
+def get_cache_path(table_path: str, remote_path: str, version: str) -> str:
+    # <table>/<partition>.<version>.parquet, so a new version never collides
+    # with a stale copy of the same partition
+    partition = get_partition(table_path, remote_path)
+    digest = hashlib.sha1(version.encode()).hexdigest()[:16]
+    return os.path.join(
+        cache_dir,
+        os.path.basename(table_path),
+        f"{partition.replace('/', '__')}.{digest}.parquet",
+    )
+
+
+def download(database: bl.Database, remote_path: str, local_path: str):
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+    # Write to a temporary file first so concurrent readers never see a partial file
+    temporary_path = f"{local_path}.{uuid.uuid4().hex}.tmp"
+    with database.file_system_client.open(remote_path, "rb") as source:
+        with open(temporary_path, "wb") as destination:
+            shutil.copyfileobj(source, destination)
+    os.replace(temporary_path, local_path)
+
+
+def remove_file(path: str) -> bool:
+    # Another process sharing the cache directory may have removed it already
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def remove_stale_versions(local_path: str):
+    partition = os.path.basename(local_path).rsplit(".", 2)[0]
+    directory = os.path.dirname(local_path)
+
+    for file_name in os.listdir(directory):
+        path = os.path.join(directory, file_name)
+        if (
+            file_name.rsplit(".", 2)[0] == partition
+            and path != local_path
+            and path not in _pins
+        ):
+            remove_file(path)
+
+
+def evict():
+    """
+    Remove the least recently used files until the cache fits its budget, never
+    touching a file pinned by a scan in progress. Must hold _lock.
+    """
+    files = []
+    total_bytes = 0
+    for directory, _, file_names in os.walk(cache_dir):
+        for file_name in file_names:
+            path = os.path.join(directory, file_name)
+            if not file_name.endswith(".parquet"):
+                continue
+
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            total_bytes += stat.st_size
+            if path not in _pins:
+                files.append((stat.st_mtime, stat.st_size, path))
+
+    for _, size, path in sorted(files):
+        if total_bytes <= cache_max_bytes:
+            break
+
+        if remove_file(path):
+            stats["cache_evictions"] += 1
+        total_bytes -= size
+
+
+def unpin(paths: list[str]):
+    """Release the files of a scan once it has been collected."""
+    with _lock:
+        _pins.subtract(paths)
+        for path in set(paths):
+            if _pins[path] <= 0:
+                del _pins[path]
+
+
+def get_cached_files(
+    database: bl.Database, name: str, partitions: list[str] | None = None
+) -> list[str]:
+    """
+    Local copies of the parquet files of a table (or only of the given
+    partitions), downloading only the ones whose remote version changed since
+    they were cached. The files stay pinned until passed to unpin.
+    """
+    table_path = database._get_table_path(name)
+
+    local_paths = []
+    try:
+        for remote_path, (version, _) in sorted(get_file_info(database, name).items()):
+            if partitions is not None and (
+                get_partition(table_path, remote_path) not in partitions
+            ):
+                continue
+
+            local_path = get_cache_path(table_path, remote_path, version)
+
+            # Pinned before the check, so no other thread can evict it in between
+            with _lock:
+                _pins[local_path] += 1
+                hit = os.path.exists(local_path)
+                stats["cache_hits" if hit else "cache_misses"] += 1
+            local_paths.append(local_path)
+
+            if hit:
+                # Modification time doubles as the last access time for eviction
+                os.utime(local_path)
+            else:
+                download(database, remote_path, local_path)
+                with _lock:
+                    remove_stale_versions(local_path)
+    except Exception:
+        # Nothing will collect a scan that failed to build
+        unpin(local_paths)
+        raise
+
+    with _lock:
+        evict()
+
+    return local_paths
+
+
+def get_table_cache_stats() -> dict[str, int]:
+    return dict(stats)
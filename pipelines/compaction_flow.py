@@ -0,0 +1,26 @@
+from clients import get_bear_lake_client
+from prefect import flow, task
+
+# Rewrite a touched partition once this many of its rows are out of order
+COMPACTION_MIN_UNSORTED_ROWS = 50_000
+COMPACTION_MIN_UNSORTED_FRACTION = 0.1
+
+
+@task
+def compact_touched_partitions():
+    bear_lake_client = get_bear_lake_client()
+
+    report = bear_lake_client.compact(
+        min_unsorted_rows=COMPACTION_MIN_UNSORTED_ROWS,
+        min_unsorted_fraction=COMPACTION_MIN_UNSORTED_FRACTION,
+    )
+
+    print(report)
+    print(f"Compacted {report['compacted'].sum()} of {len(report)} touched partitions")
+
+
+@flow
+def compaction_flow():
+    # Partitions are tracked by the process that wrote them, so this has to run
+    # in the same process as the flows that appended
+    compact_touched_partitions()
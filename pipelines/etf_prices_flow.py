@@ -1,81 +1,20 @@
 import datetime as dt
 
 import polars as pl
-from alpaca.data.enums import Adjustment, DataFeed
-from alpaca.data.requests import StockBarsRequest
-from alpaca.data.timeframe import TimeFrame, TimeFrameUnit
-from clients import (get_alpaca_historical_stock_data_client,
-                     get_bear_lake_client)
+from clients import get_bear_lake_client
 from prefect import flow, task
-from utils import get_last_market_date
+from utils import download_bars, get_last_market_date
 from variables import FACTORS, TIME_ZONE
 
 
-@task
-def get_etf_prices(
-    tickers: list[str], start: dt.datetime, end: dt.datetime
-) -> pl.DataFrame:
-    alpaca_client = get_alpaca_historical_stock_data_client()
-
-    stock_bars_request = StockBarsRequest(
-        symbol_or_symbols=tickers,
-        start=start,
-        end=end,
-        timeframe=TimeFrame(1, TimeFrameUnit.Day),
-        adjustment=Adjustment.ALL,
-        feed=DataFeed.IEX,
-    )
-
-    stock_prices_raw = alpaca_client.get_stock_bars(stock_bars_request)
-
-    if not len(stock_prices_raw.df) > 0:
-        return pl.DataFrame(
-            schema={
-                "ticker": pl.String,
-                "date": pl.Date,
-                "open": pl.Float64,
-                "high": pl.Float64,
-                "low": pl.Float64,
-                "close": pl.Float64,
-                "volume": pl.Float64,
-                "trade_count": pl.Float64,
-                "vwap": pl.Float64,
-            }
-        )
-
-    stock_prices_clean = pl.from_pandas(stock_prices_raw.df.reset_index()).select(
-        pl.col("symbol").alias("ticker"),
-        pl.col("timestamp").dt.date().alias("date"),
-        "open",
-        "high",
-        "low",
-        "close",
-        "volume",
-        "trade_count",
-        "vwap",
-    )
-
-    return stock_prices_clean
-
-
 @task
 def get_etf_prices_batches(
     tickers: list[str], start: dt.datetime, end: dt.datetime
 ) -> pl.DataFrame:
-    years = range(start.year, end.year + 1)
-    etf_prices_list = []
-    for year in years:
-        year_start = max(dt.datetime(year, 1, 1, 0, 0, 0, tzinfo=TIME_ZONE), start)
-        year_end = min(dt.datetime(year, 12, 31, 23, 59, 59, tzinfo=TIME_ZONE), end)
+    etf_prices = download_bars(tickers, start, end)
 
-        etf_prices = get_etf_prices(tickers, year_start, year_end)
-
-        etf_prices_list.append(etf_prices)
-
-    return (
-        pl.concat(etf_prices_list)
-        .with_columns(pl.col("date").dt.year().alias("year"))
-        .sort("date", "ticker")
+    return etf_prices.with_columns(pl.col("date").dt.year().alias("year")).sort(
+        "date", "ticker"
     )
 
 
@@ -103,11 +42,8 @@ def upload_and_merge_etf_prices_df(stock_prices_df: pl.DataFrame):
         mode="skip",
     )
 
-    # Insert into table
-    bear_lake_client.insert(name=table_name, data=stock_prices_df, mode="append")
-
-    # Optimize table (deduplicate)
-    bear_lake_client.optimize(name=table_name)
+    # Upsert into table
+    bear_lake_client.upsert(name=table_name, data=stock_prices_df)
 
 
 @flow
@@ -1,48 +1,87 @@
 import datetime as dt
 
+import bear_lake as bl
+import numpy as np
 import polars as pl
 from clients import get_bear_lake_client
 from prefect import flow, task
-from utils import get_etf_returns, get_trading_date_range
+from utils import (build_operator_state, check_operator_state, get_etf_returns,
+                   get_last_market_date, get_operator_state,
+                   get_trading_date_range, get_trading_days_since,
+                   rolling_covariances, update_operator_state,
+                   upload_operator_state)
 from variables import WINDOW
 
+# Smoothing applied to the raw rolling covariances, see clean_factor_covariances
+FACTOR_COVARIANCES_OPERATORS = {"half_life": 60}
+
 
 @task
 def estimate_factor_covariances(etf_returns: pl.DataFrame) -> pl.DataFrame:
-    factor_returns_pd = (
-        etf_returns.sort("ticker", "date")
-        .pivot(on="ticker", index="date", values="return")
-        .to_pandas()
-        .set_index("date")
-    )
+    factor_returns = etf_returns.pivot(
+        on="ticker", index="date", values="return", sort_columns=True
+    ).sort("date")
+    factors = factor_returns.drop("date").columns
 
-    factor_covariances = (
-        pl.from_pandas(
-            factor_returns_pd.rolling(window=WINDOW, min_periods=WINDOW)
-            .cov()
-            .reset_index()
-        )
-        .rename({"level_1": "factor_1"})
-        .with_columns(pl.col("date").dt.date())
+    covariances = rolling_covariances(
+        factor_returns.drop("date").to_numpy(), window=WINDOW
     )
 
-    return factor_covariances
+    # (date x K x K) flattens row major into date, factor_1, factor_2
+    K = len(factors)
+    return pl.DataFrame(
+        {
+            "date": np.repeat(factor_returns["date"].to_numpy(), K * K),
+            "factor_1": np.tile(np.repeat(factors, K), len(factor_returns)),
+            "factor_2": np.tile(factors, K * len(factor_returns)),
+            "covariance": covariances.reshape(-1),
+        }
+    ).with_columns(pl.col("covariance").fill_nan(None))
+
+
+def get_complete_factor_covariances(factor_covariances: pl.DataFrame) -> pl.DataFrame:
+    # Only dates with a complete covariance matrix
+    return factor_covariances.filter(
+        pl.col("covariance").is_not_null().all().over("date")
+    ).sort("factor_1", "factor_2", "date")
 
 
 @task
 def clean_factor_covariances(factor_covariances: pl.DataFrame) -> pl.DataFrame:
-    return (
-        factor_covariances.drop_nulls()
-        .unpivot(
-            index=["date", "factor_1"],
-            variable_name="factor_2",
-            value_name="covariance",
-        )
-        .sort("factor_1", "factor_2", "date")
-        .with_columns(
-            pl.col("covariance").ewm_mean(half_life=60).over("factor_1", "factor_2"),
-            pl.col("date").dt.year().alias("year"),
-        )
+    return get_complete_factor_covariances(factor_covariances).with_columns(
+        pl.col("covariance")
+        .ewm_mean(half_life=FACTOR_COVARIANCES_OPERATORS["half_life"])
+        .over("factor_1", "factor_2"),
+        pl.col("date").dt.year().alias("year"),
+    )
+
+
+@task
+def build_smoothing_state(factor_covariances: pl.DataFrame):
+    # Full rebuild over the whole history, which is what the backfill smooths
+    state, _ = build_operator_state(
+        get_complete_factor_covariances(factor_covariances),
+        keys=["factor_1", "factor_2"],
+        value="covariance",
+        **FACTOR_COVARIANCES_OPERATORS,
+    )
+    upload_operator_state("factor_covariances", state)
+
+
+@task
+def update_smoothing_state(
+    state: pl.DataFrame, factor_covariances: pl.DataFrame
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    # Smooth only the new raw covariances, carrying each EWM from its state
+    state, factor_covariances = update_operator_state(
+        state,
+        get_complete_factor_covariances(factor_covariances),
+        keys=["factor_1", "factor_2"],
+        value="covariance",
+        **FACTOR_COVARIANCES_OPERATORS,
+    )
+    return state, factor_covariances.with_columns(
+        pl.col("date").dt.year().alias("year")
     )
 
 
@@ -66,11 +105,8 @@ def upload_and_merge_factor_covariances(factor_covariances: pl.DataFrame):
         mode="skip",
     )
 
-    # Insert data
-    bear_lake_client.insert(name=table_name, data=factor_covariances, mode="append")
-
-    # Optimize
-    bear_lake_client.optimize(name=table_name)
+    # Upsert data
+    bear_lake_client.upsert(name=table_name, data=factor_covariances)
 
 
 @flow
@@ -84,27 +120,77 @@ def factor_covariances_backfill_flow():
     factor_covariances_clean = clean_factor_covariances(factor_covariances)
 
     upload_and_merge_factor_covariances(factor_covariances_clean)
+    build_smoothing_state(factor_covariances)
 
 
 @flow
-def factor_covariances_daily_flow():
-    date_range = get_trading_date_range(window=WINDOW)
+def factor_covariances_smoothing_check_flow():
+    # EWMs depend on the whole history, so this has to redo the full backfill
+    start = dt.date(2020, 7, 28)
+    end = dt.date.today() - dt.timedelta(days=1)
 
-    start = date_range["date"].min()
-    end = date_range["date"].max()
+    etf_returns = get_etf_returns(start, end)
+    factor_covariances = estimate_factor_covariances(etf_returns)
+
+    # Also diff the outputs the daily updates wrote over the last window
+    bear_lake_client = get_bear_lake_client()
+    since = get_trading_date_range(window=WINDOW)["date"].min()
+    factor_covariances_stored = bear_lake_client.query(
+        bl.table("factor_covariances").filter(pl.col("date") >= since)
+    )
 
+    check_operator_state(
+        get_operator_state("factor_covariances"),
+        get_complete_factor_covariances(factor_covariances),
+        keys=["factor_1", "factor_2"],
+        value="covariance",
+        outputs=factor_covariances_stored.select(
+            "factor_1", "factor_2", "date", "covariance"
+        ),
+        **FACTOR_COVARIANCES_OPERATORS,
+    )
+
+
+@flow
+def factor_covariances_daily_flow():
+    last_market_date = get_last_market_date()
     yesterday = dt.date.today() - dt.timedelta(days=1)
 
     # Only get new data if yesterday was the last market date
-    if end != yesterday:
+    if last_market_date != yesterday:
         print("Market was not open yesterday!")
-        print("Last Market Date:", end)
+        print("Last Market Date:", last_market_date)
         print("Yesterday:", yesterday)
         return
 
+    state = get_operator_state("factor_covariances")
+    watermark = state["date"].max()
+
+    if watermark is None:
+        raise ValueError(
+            "Factor covariances state is empty! Run factor_covariances_backfill_flow."
+        )
+
+    if watermark >= last_market_date:
+        print("Factor covariances state is already up to date!")
+        print("State Date:", watermark)
+        return
+
+    # One window of returns for every date since the state was last updated, so
+    # days the flow missed are caught up rather than skipped by the EWMs
+    missed_days = get_trading_days_since(watermark)
+    date_range = get_trading_date_range(window=WINDOW + missed_days - 1)
+
+    start = date_range["date"].min()
+    end = date_range["date"].max()
+
     etf_returns = get_etf_returns(start, end)
 
+    # Only dates with a full window have a complete covariance matrix, and
+    # dates already in the state are skipped
     factor_covariances = estimate_factor_covariances(etf_returns)
-    factor_covariances_clean = clean_factor_covariances(factor_covariances)
+    state, factor_covariances_clean = update_smoothing_state(state, factor_covariances)
 
+    # Outputs first, so a failure before the state is saved just redoes the day
     upload_and_merge_factor_covariances(factor_covariances_clean)
+    upload_operator_state("factor_covariances", state)
@@ -1,62 +1,45 @@
 import datetime as dt
 
+import bear_lake as bl
+import numpy as np
 import polars as pl
-import statsmodels.api as sm
 from clients import get_bear_lake_client
 from prefect import flow, task
-from statsmodels.regression.rolling import RollingOLS
-from tqdm import tqdm
-from utils import get_etf_returns, get_stock_returns, get_trading_date_range
-from variables import DISABLE_TQDM, FACTORS, WINDOW
+from utils import (add_constant, build_operator_state, check_operator_state,
+                   get_etf_returns, get_last_market_date, get_operator_state,
+                   get_stock_returns, get_trading_date_range, group_sums,
+                   rolling_ols, solve_windows, update_operator_state,
+                   update_windowed_sums, upload_operator_state)
+from variables import FACTORS, WINDOW
 
+# Smoothing applied to the raw regression outputs, see clean_factor_loadings
+# and clean_idio_vol
+FACTOR_LOADINGS_OPERATORS = {"half_life": 60}
+IDIO_VOL_OPERATORS = {"rolling": "std", "window": WINDOW, "half_life": 60}
 
-@task
-def estimate_regression(
+
+def join_factor_returns(
     stock_returns: pl.DataFrame, etf_returns: pl.DataFrame
-) -> tuple[pl.DataFrame]:
-    df = stock_returns.join(
-        other=etf_returns.pivot(on="ticker", index="date", values="return"),
-        how="left",
-        on="date",
-    )
-
-    results = []
-    for ticker in tqdm(
-        df["ticker"].unique(), desc="Estimating factor loadings", disable=DISABLE_TQDM
-    ):
-        ticker_df = df.filter(pl.col("ticker") == ticker).sort("date")
-
-        if len(ticker_df) < WINDOW:
-            result = pl.DataFrame(
-                {
-                    "ticker": ticker,
-                    "date": ticker_df["date"],
-                    "return": ticker_df["return"],
-                    "alpha": None,
-                }
-                | {factor: ticker_df[factor] for factor in FACTORS}
-                | {f"B_{factor}": None for factor in FACTORS}
-            )
-            continue
-
-        y = ticker_df["return"].to_pandas()
-        X = sm.add_constant(ticker_df.select(FACTORS).to_pandas())
-
-        rolling_model = RollingOLS(y, X, window=WINDOW).fit()
-
-        result = pl.DataFrame(
-            {
-                "ticker": ticker,
-                "date": ticker_df["date"],
-                "return": ticker_df["return"],
-                "alpha": rolling_model.params["const"],
-            }
-            | {factor: ticker_df[factor] for factor in FACTORS}
-            | {f"B_{factor}": rolling_model.params[factor] for factor in FACTORS}
+) -> pl.DataFrame:
+    return (
+        stock_returns.join(
+            other=etf_returns.pivot(on="ticker", index="date", values="return"),
+            how="left",
+            on="date",
         )
-        results.append(result)
+        .select("ticker", "date", "return", *FACTORS)
+        .sort("ticker", "date")
+    )
+
 
-    results = pl.concat(results).with_columns(
+def add_regression_results(df: pl.DataFrame, params: np.ndarray) -> pl.DataFrame:
+    return df.with_columns(
+        pl.Series("alpha", params[:, 0], nan_to_null=True),
+        *[
+            pl.Series(f"B_{factor}", params[:, i + 1], nan_to_null=True)
+            for i, factor in enumerate(FACTORS)
+        ],
+    ).with_columns(
         pl.col("return")
         .sub(
             pl.col("alpha")
@@ -67,6 +50,134 @@ def estimate_regression(
         .alias("residual")
     )
 
+
+def fit_rolling_regression(df: pl.DataFrame) -> pl.DataFrame:
+    params = rolling_ols(
+        y=df["return"].to_numpy(),
+        X=df.select(FACTORS).to_numpy(),
+        groups=df["ticker"].rle_id().to_numpy(),
+        window=WINDOW,
+    )
+
+    # Tickers with less than WINDOW observations come through with null loadings
+    return add_regression_results(df, params)
+
+
+def get_state_arrays(
+    state: pl.DataFrame,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Tickers without a state yet start from an empty window
+    n_params = len(FACTORS) + 1
+    xtx = np.array(
+        [
+            row if row is not None else [0.0] * n_params**2
+            for row in state["xtx"].to_list()
+        ]
+    ).reshape(-1, n_params, n_params)
+    xty = np.array(
+        [row if row is not None else [0.0] * n_params for row in state["xty"].to_list()]
+    ).reshape(-1, n_params)
+    yty = state["yty"].fill_null(0.0).to_numpy()
+    count = state["count"].fill_null(0).to_numpy()
+
+    return xtx, xty, yty, count
+
+
+def get_state_frame(
+    tickers: pl.Series,
+    dates: pl.Series,
+    xtx: np.ndarray,
+    xty: np.ndarray,
+    yty: np.ndarray,
+    count: np.ndarray,
+) -> pl.DataFrame:
+    return pl.DataFrame(
+        {
+            "ticker": tickers,
+            "date": dates,
+            "count": pl.Series(count, dtype=pl.Int64),
+            "xtx": pl.Series(
+                xtx.reshape(len(xtx), -1).tolist(), dtype=pl.List(pl.Float64)
+            ),
+            "xty": pl.Series(xty.tolist(), dtype=pl.List(pl.Float64)),
+            "yty": pl.Series(yty, dtype=pl.Float64),
+        }
+    )
+
+
+def get_state_from_window(window: pl.DataFrame) -> pl.DataFrame:
+    window = window.sort("ticker", "date")
+
+    xtx, xty, yty, count = group_sums(
+        y=window["return"].to_numpy(),
+        X=add_constant(window.select(FACTORS).to_numpy()),
+        groups=window["ticker"].rle_id().to_numpy(),
+    )
+
+    last_dates = window.group_by("ticker", maintain_order=True).agg(
+        pl.col("date").last()
+    )
+
+    return get_state_frame(
+        last_dates["ticker"], last_dates["date"], xtx, xty, yty, count
+    )
+
+
+def roll_regression_state(
+    state: pl.DataFrame, window: pl.DataFrame, returns: pl.DataFrame
+) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    # Roll every ticker with a return on this date forward by one observation
+    returns = returns.sort("ticker")
+
+    oldest = (
+        window.sort("ticker", "date")
+        .group_by("ticker")
+        .agg(pl.len().alias("length"), pl.col("return", *FACTORS).first())
+    )
+    current = (
+        returns.select("ticker")
+        .join(state, on="ticker", how="left")
+        .join(oldest, on="ticker", how="left")
+    )
+
+    length = current["length"].fill_null(0).to_numpy()
+    full = length == WINDOW
+
+    xtx, xty, yty, count = update_windowed_sums(
+        *get_state_arrays(current),
+        y_old=np.where(full, current["return"].to_numpy(), np.nan),
+        X_old=np.where(
+            full[:, None], add_constant(current.select(FACTORS).to_numpy()), np.nan
+        ),
+        y_new=returns["return"].to_numpy(),
+        X_new=add_constant(returns.select(FACTORS).to_numpy()),
+    )
+
+    params = solve_windows(xtx, xty, count, np.minimum(length + 1, WINDOW) == WINDOW)
+    results = add_regression_results(returns, params)
+
+    window = (
+        pl.concat([window, results])
+        .sort("ticker", "date")
+        .group_by("ticker", maintain_order=True)
+        .tail(WINDOW)
+    )
+    state = pl.concat(
+        [
+            state.filter(~pl.col("ticker").is_in(returns["ticker"].to_list())),
+            get_state_frame(returns["ticker"], returns["date"], xtx, xty, yty, count),
+        ]
+    ).sort("ticker")
+
+    return state, window, results
+
+
+@task
+def estimate_regression(
+    stock_returns: pl.DataFrame, etf_returns: pl.DataFrame
+) -> tuple[pl.DataFrame]:
+    results = fit_rolling_regression(join_factor_returns(stock_returns, etf_returns))
+
     betas = results.select("ticker", "date", *[f"B_{factor}" for factor in FACTORS])
     residuals = results.select("ticker", "date", "residual")
 
@@ -74,19 +185,116 @@ def estimate_regression(
 
 
 @task
-def clean_factor_loadings(factor_loadings: pl.DataFrame) -> pl.DataFrame:
+def build_regression_state(
+    stock_returns: pl.DataFrame, etf_returns: pl.DataFrame
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    # The last WINDOW regressions of a ticker only need its last 2 * WINDOW - 1 rows
+    df = (
+        join_factor_returns(stock_returns, etf_returns)
+        .group_by("ticker", maintain_order=True)
+        .tail(2 * WINDOW - 1)
+    )
+
+    window = (
+        fit_rolling_regression(df).group_by("ticker", maintain_order=True).tail(WINDOW)
+    )
+    state = get_state_from_window(window)
+
+    return state, window
+
+
+@task
+def update_regression_state(
+    state: pl.DataFrame,
+    window: pl.DataFrame,
+    stock_returns: pl.DataFrame,
+    etf_returns: pl.DataFrame,
+) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    df = join_factor_returns(stock_returns, etf_returns)
+
+    results_list = []
+    for _, returns in df.sort("date").group_by("date", maintain_order=True):
+        state, window, results = roll_regression_state(state, window, returns)
+        results_list.append(results)
+
+    return state, window, pl.concat(results_list)
+
+
+@task
+def check_regression_state(
+    state: pl.DataFrame,
+    window: pl.DataFrame,
+    stock_returns: pl.DataFrame,
+    etf_returns: pl.DataFrame,
+    tolerance: float = 1e-6,
+):
+    # Sums carried forward day by day should match sums recomputed from the window
+    rebuilt = state.select("ticker").join(
+        get_state_from_window(window), on="ticker", how="left"
+    )
+    sums_error = max(
+        np.abs(carried - recomputed).max(initial=0)
+        for carried, recomputed in zip(
+            get_state_arrays(state), get_state_arrays(rebuilt)
+        )
+    )
+
+    # Stored regressions should match a full backfill over the same returns
+    columns = ["alpha", *[f"B_{factor}" for factor in FACTORS], "residual"]
+    backfill = fit_rolling_regression(join_factor_returns(stock_returns, etf_returns))
+    compared = window.select("ticker", "date", *columns).join(
+        backfill.select("ticker", "date", *columns),
+        on=["ticker", "date"],
+        how="inner",
+        suffix="_backfill",
+    )
+    backfill_error = compared.select(
+        pl.max_horizontal(
+            pl.col(column).sub(pl.col(f"{column}_backfill")).abs().max()
+            for column in columns
+        )
+    ).item()
+    backfill_error = backfill_error or 0.0
+
+    print("Max state sums error:", sums_error)
+    print("Max backfill error:", backfill_error)
+
+    if sums_error > tolerance or backfill_error > tolerance:
+        raise ValueError(
+            "Factor model state has drifted from the backfill! "
+            "Run factor_model_state_backfill_flow to rebuild it."
+        )
+
+
+@task
+def get_regression_state() -> tuple[pl.DataFrame, pl.DataFrame]:
+    bear_lake_client = get_bear_lake_client()
+    state = bear_lake_client.query(bl.table("factor_model_state").sort("ticker"))
+    window = bear_lake_client.query(
+        bl.table("factor_model_window").sort("ticker", "date")
+    )
+    return state, window
+
+
+def get_raw_factor_loadings(betas: pl.DataFrame) -> pl.DataFrame:
     return (
-        factor_loadings.unpivot(
+        betas.unpivot(
             index=["ticker", "date"], variable_name="factor", value_name="loading"
         )
         .sort("ticker", "date")
         .with_columns(
             pl.col("factor").replace({f"B_{factor}": factor for factor in FACTORS})
         )
-        .with_columns(
-            pl.col("loading").ewm_mean(half_life=60).over("ticker", "factor"),
-            pl.col("date").dt.year().alias("year"),
-        )
+    )
+
+
+@task
+def clean_factor_loadings(factor_loadings: pl.DataFrame) -> pl.DataFrame:
+    return get_raw_factor_loadings(factor_loadings).with_columns(
+        pl.col("loading")
+        .ewm_mean(half_life=FACTOR_LOADINGS_OPERATORS["half_life"])
+        .over("ticker", "factor"),
+        pl.col("date").dt.year().alias("year"),
     )
 
 
@@ -97,13 +305,66 @@ def clean_idio_vol(residuals: pl.DataFrame) -> pl.DataFrame:
         "date",
         pl.col("date").dt.year().alias("year"),
         pl.col("residual")
-        .rolling_std(window_size=WINDOW)
-        .ewm_mean(half_life=60)
+        .rolling_std(window_size=IDIO_VOL_OPERATORS["window"])
+        .ewm_mean(half_life=IDIO_VOL_OPERATORS["half_life"])
         .over("ticker")
         .alias("idio_vol"),
     )
 
 
+@task
+def build_smoothing_state(betas: pl.DataFrame, residuals: pl.DataFrame):
+    # Full rebuild over the whole history, which is what the backfill smooths
+    factor_loadings_state, _ = build_operator_state(
+        get_raw_factor_loadings(betas),
+        keys=["ticker", "factor"],
+        value="loading",
+        **FACTOR_LOADINGS_OPERATORS,
+    )
+    idio_vol_state, _ = build_operator_state(
+        residuals, keys=["ticker"], value="residual", **IDIO_VOL_OPERATORS
+    )
+
+    upload_operator_state("factor_loadings", factor_loadings_state)
+    upload_operator_state("idio_vol", idio_vol_state)
+
+
+@task
+def update_smoothing_state(
+    betas: pl.DataFrame, residuals: pl.DataFrame
+) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    """
+    Smooth only the new raw loadings and residuals, carrying each series' EWM
+    and rolling window forward from its stored state.
+    """
+    factor_loadings_state, factor_loadings = update_operator_state(
+        get_operator_state("factor_loadings"),
+        get_raw_factor_loadings(betas),
+        keys=["ticker", "factor"],
+        value="loading",
+        **FACTOR_LOADINGS_OPERATORS,
+    )
+    idio_vol_state, idio_vol = update_operator_state(
+        get_operator_state("idio_vol"),
+        residuals,
+        keys=["ticker"],
+        value="residual",
+        **IDIO_VOL_OPERATORS,
+    )
+
+    factor_loadings = factor_loadings.with_columns(
+        pl.col("date").dt.year().alias("year")
+    )
+    idio_vol = idio_vol.select(
+        "ticker",
+        "date",
+        pl.col("date").dt.year().alias("year"),
+        pl.col("residual").alias("idio_vol"),
+    )
+
+    return factor_loadings_state, idio_vol_state, factor_loadings, idio_vol
+
+
 @task
 def upload_and_merge_factor_loadings(factor_loadings: pl.DataFrame) -> pl.DataFrame:
     bear_lake_client = get_bear_lake_client()
@@ -124,11 +385,8 @@ def upload_and_merge_factor_loadings(factor_loadings: pl.DataFrame) -> pl.DataFr
         mode="skip",
     )
 
-    # Insert data
-    bear_lake_client.insert(name=table_name, data=factor_loadings, mode="append")
-
-    # Optimize
-    bear_lake_client.optimize(name=table_name)
+    # Upsert data
+    bear_lake_client.upsert(name=table_name, data=factor_loadings)
 
 
 @task
@@ -150,11 +408,48 @@ def upload_and_merge_idio_vol(idio_vol: pl.DataFrame) -> pl.DataFrame:
         mode="skip",
     )
 
-    # Insert data
-    bear_lake_client.insert(name=table_name, data=idio_vol, mode="append")
+    # Upsert data
+    bear_lake_client.upsert(name=table_name, data=idio_vol)
+
+
+@task
+def upload_regression_state(state: pl.DataFrame, window: pl.DataFrame):
+    bear_lake_client = get_bear_lake_client()
+
+    # Create or replace tables
+    bear_lake_client.create(
+        name="factor_model_state",
+        schema={
+            "ticker": pl.String,
+            "date": pl.Date,
+            "count": pl.Int64,
+            "xtx": pl.List(pl.Float64),
+            "xty": pl.List(pl.Float64),
+            "yty": pl.Float64,
+        },
+        partition_keys=None,
+        primary_keys=["ticker"],
+        mode="replace",
+    )
+    bear_lake_client.create(
+        name="factor_model_window",
+        schema={
+            "ticker": pl.String,
+            "date": pl.Date,
+            "return": pl.Float64,
+        }
+        | {factor: pl.Float64 for factor in FACTORS}
+        | {"alpha": pl.Float64}
+        | {f"B_{factor}": pl.Float64 for factor in FACTORS}
+        | {"residual": pl.Float64},
+        partition_keys=None,
+        primary_keys=["ticker", "date"],
+        mode="replace",
+    )
 
-    # Optimize
-    bear_lake_client.optimize(name=table_name)
+    # Insert data
+    bear_lake_client.insert(name="factor_model_state", data=state, mode="append")
+    bear_lake_client.insert(name="factor_model_window", data=window, mode="append")
 
 
 @flow
@@ -173,30 +468,129 @@ def factor_model_backfill_flow():
     upload_and_merge_factor_loadings(factor_loadings)
     upload_and_merge_idio_vol(idio_vol)
 
+    build_smoothing_state(betas, residuals)
+
+    state, window = build_regression_state(stock_returns, etf_returns)
+    upload_regression_state(state, window)
+
 
 @flow
-def factor_model_daily_flow():
+def factor_model_state_backfill_flow():
     date_range = get_trading_date_range(window=WINDOW * 2)
 
     start = date_range["date"].min()
     end = date_range["date"].max()
 
+    stock_returns = get_stock_returns(start, end)
+    etf_returns = get_etf_returns(start, end)
+
+    state, window = build_regression_state(stock_returns, etf_returns)
+    upload_regression_state(state, window)
+
+
+@flow
+def factor_model_state_check_flow():
+    state, window = get_regression_state()
+    date_range = get_trading_date_range(window=WINDOW * 3)
+
+    start = date_range["date"].min()
+    end = state["date"].max()
+
+    stock_returns = get_stock_returns(start, end)
+    etf_returns = get_etf_returns(start, end)
+
+    check_regression_state(state, window, stock_returns, etf_returns)
+
+
+@flow
+def factor_model_smoothing_check_flow():
+    # EWMs depend on the whole history, so this has to redo the full backfill
+    start = dt.date(2020, 7, 28)
+    end = dt.date.today() - dt.timedelta(days=1)
+
+    stock_returns = get_stock_returns(start, end)
+    etf_returns = get_etf_returns(start, end)
+
+    betas, residuals = estimate_regression(stock_returns, etf_returns)
+
+    # Also diff the outputs the daily updates wrote over the last window
+    bear_lake_client = get_bear_lake_client()
+    since = get_trading_date_range(window=WINDOW)["date"].min()
+    factor_loadings = bear_lake_client.query(
+        bl.table("factor_loadings").filter(pl.col("date") >= since)
+    )
+    idio_vol = bear_lake_client.query(
+        bl.table("idio_vol").filter(pl.col("date") >= since)
+    )
+
+    check_operator_state(
+        get_operator_state("factor_loadings"),
+        get_raw_factor_loadings(betas),
+        keys=["ticker", "factor"],
+        value="loading",
+        outputs=factor_loadings.select("ticker", "factor", "date", "loading"),
+        **FACTOR_LOADINGS_OPERATORS,
+    )
+    check_operator_state(
+        get_operator_state("idio_vol"),
+        residuals,
+        keys=["ticker"],
+        value="residual",
+        outputs=idio_vol.select("ticker", "date", pl.col("idio_vol").alias("residual")),
+        **IDIO_VOL_OPERATORS,
+    )
+
+
+@flow
+def factor_model_daily_flow():
+    last_market_date = get_last_market_date()
     yesterday = dt.date.today() - dt.timedelta(days=1)
 
     # Only get new data if yesterday was the last market date
-    if end != yesterday:
+    if last_market_date != yesterday:
         print("Market was not open yesterday!")
-        print("Last Market Date:", end)
+        print("Last Market Date:", last_market_date)
         print("Yesterday:", yesterday)
         return
 
+    state, window = get_regression_state()
+    watermark = state["date"].max()
+
+    if watermark is None:
+        raise ValueError(
+            "Factor model state is empty! Run factor_model_state_backfill_flow."
+        )
+
+    if watermark >= last_market_date:
+        print("Factor model state is already up to date!")
+        print("State Date:", watermark)
+        return
+
+    # Only the returns since the state was last updated are needed
+    start = watermark + dt.timedelta(days=1)
+    end = last_market_date
+
     stock_returns = get_stock_returns(start, end)
     etf_returns = get_etf_returns(start, end)
 
-    betas, residuals = estimate_regression(stock_returns, etf_returns)
+    if not len(stock_returns) > 0:
+        raise ValueError("No new stock returns found!")
+
+    state, window, results = update_regression_state(
+        state, window, stock_returns, etf_returns
+    )
 
-    factor_loadings = clean_factor_loadings(betas).filter(pl.col("date").eq(end))
-    idio_vol = clean_idio_vol(residuals).filter(pl.col("date").eq(end))
+    betas = results.select("ticker", "date", *[f"B_{factor}" for factor in FACTORS])
+    residuals = results.select("ticker", "date", "residual")
 
+    factor_loadings_state, idio_vol_state, factor_loadings, idio_vol = (
+        update_smoothing_state(betas, residuals)
+    )
+
+    # Outputs first, so a failure before the states are saved just redoes the day
     upload_and_merge_factor_loadings(factor_loadings)
     upload_and_merge_idio_vol(idio_vol)
+
+    upload_operator_state("factor_loadings", factor_loadings_state)
+    upload_operator_state("idio_vol", idio_vol_state)
+    upload_regression_state(state, window)
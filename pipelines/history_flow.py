@@ -1,4 +1,6 @@
 import datetime as dt
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
 from zoneinfo import ZoneInfo
 
 import bear_lake as bl
@@ -13,18 +15,34 @@ from rich import print
 from utils import get_last_market_date
 from variables import FACTORS, TIME_ZONE
 
+MAX_IN_FLIGHT_DAYS = 4
+
+HISTORY_SCHEMA = {
+    "ticker": pl.String,
+    "date": pl.Date,
+    "timestamp": pl.Datetime,
+    "open": pl.Float64,
+    "high": pl.Float64,
+    "low": pl.Float64,
+    "close": pl.Float64,
+    "volume": pl.Float64,
+    "vwap": pl.Float64,
+    "trade_count": pl.Float64,
+}
+
 
 @task
 def get_tickers() -> list[str]:
     bear_lake_client = get_bear_lake_client()
     return (
-        bear_lake_client.query(bl.table("universe").select("ticker").unique())["ticker"]
+        bear_lake_client.query(
+            bl.table("universe_intervals").select("ticker").unique()
+        )["ticker"]
         .sort()
         .to_list()
     )
 
 
-@task
 def get_history_by_date(tickers: list[str], date_: dt.date) -> pl.DataFrame:
     ext_open = dt.time(4, 0, 0, tzinfo=ZoneInfo("America/New_York"))
     ext_close = dt.time(20, 0, 0, tzinfo=ZoneInfo("America/New_York"))
@@ -44,7 +62,16 @@ def get_history_by_date(tickers: list[str], date_: dt.date) -> pl.DataFrame:
 
     stock_bars = alpaca_client.get_stock_bars(request)
 
-    return pl.from_pandas(stock_bars.df.reset_index()).rename({"symbol": "ticker"})
+    if not len(stock_bars.df) > 0:
+        return pl.DataFrame(schema=HISTORY_SCHEMA)
+
+    # Extended hours run past midnight UTC, so the partition is the market date
+    return (
+        pl.from_pandas(stock_bars.df.reset_index())
+        .rename({"symbol": "ticker"})
+        .with_columns(pl.lit(date_).alias("date"))
+        .select(HISTORY_SCHEMA.keys())
+    )
 
 
 @task
@@ -61,44 +88,40 @@ def get_market_dates(start: dt.date, end: dt.date) -> list[dt.date]:
 
 
 @task
-def get_history(tickers: list[str], start: dt.date, end: dt.date):
+def upload_and_merge_history(
+    tickers: list[str], start: dt.date, end: dt.date, table_name: str
+):
     market_dates = get_market_dates(start, end)
-
-    history_list = []
-    for market_date in market_dates:
-        history_list.append(get_history_by_date(tickers, market_date))
-
-    return pl.concat(history_list)
-
-
-@task
-def upload_and_merge_history(history: pl.DataFrame, table_name: str):
     bear_lake_client = get_bear_lake_client()
 
     # Create table if not exists
     bear_lake_client.create(
         name=table_name,
-        schema={
-            "ticker": pl.String,
-            "timestamp": pl.Datetime,
-            "open": pl.Float64,
-            "high": pl.Float64,
-            "low": pl.Float64,
-            "close": pl.Float64,
-            "volume": pl.Float64,
-            "vwap": pl.Float64,
-            "trade_count": pl.Float64,
-        },
-        partition_keys=None,
+        schema=HISTORY_SCHEMA,
+        partition_keys=["date"],
         primary_keys=["timestamp", "ticker"],
         mode="skip",
     )
 
-    # Insert into table
-    bear_lake_client.insert(name=table_name, data=history, mode="append")
+    def upsert_history(futures: set[Future]):
+        for future in futures:
+            history = future.result()
+            if len(history) > 0:
+                bear_lake_client.upsert(name=table_name, data=history)
+
+    # Fetch days concurrently and upsert each one as soon as it arrives into its
+    # own partition, so at most MAX_IN_FLIGHT_DAYS days of minute bars are held
+    # in memory and each upsert only reads and writes that day's file
+    with ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT_DAYS) as executor:
+        pending = set()
+        for market_date in market_dates:
+            if len(pending) >= MAX_IN_FLIGHT_DAYS:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                upsert_history(done)
 
-    # Optimize table (deduplicate)
-    bear_lake_client.optimize(name=table_name)
+            pending.add(executor.submit(get_history_by_date, tickers, market_date))
+
+        upsert_history(wait(pending).done)
 
 
 @flow
@@ -107,9 +130,7 @@ def etf_history_backfill_flow():
     end = (dt.datetime.now(TIME_ZONE) - dt.timedelta(days=1)).date()
     tickers = FACTORS
 
-    etf_history = get_history(tickers, start, end)
-
-    upload_and_merge_history(etf_history, "etf_history")
+    upload_and_merge_history(tickers, start, end, "etf_history")
 
 
 @flow
@@ -125,9 +146,7 @@ def etf_history_daily_flow():
         print("Yesterday:", yesterday)
         return
 
-    etf_history = get_history(tickers, last_market_date, last_market_date)
-
-    upload_and_merge_history(etf_history, "etf_history")
+    upload_and_merge_history(tickers, last_market_date, last_market_date, "etf_history")
 
 
 @flow
@@ -136,9 +155,7 @@ def stock_history_backfill_flow():
     end = (dt.datetime.now(TIME_ZONE) - dt.timedelta(days=1)).date()
     tickers = get_tickers()
 
-    stock_history = get_history(tickers, start, end)
-
-    upload_and_merge_history(stock_history, "stock_history")
+    upload_and_merge_history(tickers, start, end, "stock_history")
 
 
 @flow
@@ -154,6 +171,6 @@ def stock_history_daily_flow():
         print("Yesterday:", yesterday)
         return
 
-    stock_history = get_history(tickers, last_market_date, last_market_date)
-
-    upload_and_merge_history(stock_history, "stock_history")
+    upload_and_merge_history(
+        tickers, last_market_date, last_market_date, "stock_history"
+    )
@@ -82,11 +82,8 @@ def upload_and_merge_portfolio_history(portfolio_history: pl.DataFrame):
         mode="skip",
     )
 
-    # Insert into table
-    bear_lake_client.insert(name=table_name, data=portfolio_history, mode="append")
-
-    # Optimize table (deduplicate)
-    bear_lake_client.optimize(name=table_name)
+    # Upsert into table
+    bear_lake_client.upsert(name=table_name, data=portfolio_history)
 
 
 @flow
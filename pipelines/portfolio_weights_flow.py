@@ -1,63 +1,117 @@
 import datetime as dt
 import os
+from collections import defaultdict
 
+import bear_lake as bl
 import polars as pl
+import pyarrow as pa
 import ray
 from clients import get_bear_lake_client
 from prefect import flow, task
-from utils import (get_alphas, get_benchmark_weights, get_covariance_matrix,
-                   get_factor_covariances, get_factor_loadings, get_idio_vol,
-                   get_last_market_date, get_optimal_weights_dynamic)
-from variables import TARGET_ACTIVE_RISK
+from utils import (get_last_market_date, get_model_snapshot,
+                   get_optimal_weights_dynamic, get_portfolio_metrics,
+                   get_portfolio_weights, get_risk_model,
+                   get_trading_date_range)
+from variables import (BENCHMARK, CACHE_BENCHMARK_WEIGHTS, OPTIMIZER,
+                       RISK_MODEL, TARGET_ACTIVE_RISK)
 
 # Suppress Ray GPU warning for CPU-only usage
 os.environ["RAY_ACCEL_ENV_VAR_OVERRIDE_ON_ZERO"] = "0"
 
+# Dates solved per Ray task and weight rows buffered per table write
+BATCH_SIZE = 21
+WRITE_CHUNK_SIZE = 250_000
 
-@ray.remote
-def get_portfolio_weights_for_date_parallel(
-    date_: str,
-    alphas: pl.DataFrame,
-    benchmark_weights: pl.DataFrame,
-    factor_loadings: pl.DataFrame,
-    factor_covariances: pl.DataFrame,
-    idio_vol: pl.DataFrame,
-) -> tuple[pl.DataFrame, pl.DataFrame]:
-    alphas_slice = alphas.filter(pl.col("date").eq(date_)).sort("ticker")
-    tickers = alphas_slice["ticker"].unique().sort().to_list()
 
-    benchmark_weights_slice = benchmark_weights.filter(pl.col("date").eq(date_)).sort(
-        "ticker"
-    )
+def get_date_batches(dates: list[dt.date], batch_size: int) -> list[list[dt.date]]:
+    return [dates[i : i + batch_size] for i in range(0, len(dates), batch_size)]
+
 
-    factor_loadings_slice = factor_loadings.filter(pl.col("date").eq(date_)).sort(
-        "ticker"
+def partition_by_batch(
+    df: pl.DataFrame, batches: list[list[dt.date]]
+) -> list[pa.Table]:
+    # Sort once and slice contiguous date ranges out of the same buffers instead of
+    # filtering the full frame for every batch
+    df = df.sort("date")
+    starts = df["date"].search_sorted(
+        pl.Series([batch[0] for batch in batches]), side="left"
     )
-    factor_covariances_slice = factor_covariances.filter(pl.col("date").eq(date_)).sort(
-        "factor_1"
+    ends = df["date"].search_sorted(
+        pl.Series([batch[-1] for batch in batches]), side="right"
     )
-    idio_vol_slice = idio_vol.filter(pl.col("date").eq(date_)).sort("ticker")
 
-    covariance_matrix = get_covariance_matrix(
-        tickers=tickers,
-        factor_loadings=factor_loadings_slice,
-        factor_covariances=factor_covariances_slice,
-        idio_vol=idio_vol_slice,
-    )
+    return [df.slice(start, end - start).to_arrow() for start, end in zip(starts, ends)]
 
-    optimal_weights, lambda_, active_risk = get_optimal_weights_dynamic(
-        alphas=alphas_slice,
-        covariance_matrix=covariance_matrix,
-        benchmark_weights=benchmark_weights_slice,
-        target_active_risk=TARGET_ACTIVE_RISK,
-    )
 
-    weights_df = optimal_weights.with_columns(pl.lit(date_).alias("date"))
-    metrics_df = pl.DataFrame(
-        {"lambda": [lambda_], "active_risk": [active_risk], "date": [str(date_)]}
-    )
+def partition_by_date(table: pa.Table) -> dict[tuple[dt.date], pl.DataFrame]:
+    df = pl.from_arrow(table)
+    # Dates without rows (e.g. before a full covariance window) get an empty
+    # slice, as filtering on the date would
+    return defaultdict(df.clear, df.partition_by("date", as_dict=True))
 
-    return weights_df, metrics_df
+
+@ray.remote
+def get_portfolio_weights_for_batch_parallel(
+    dates: list[dt.date],
+    alphas: pa.Table,
+    benchmark_weights: pa.Table,
+    factor_loadings: pa.Table,
+    factor_covariances: pa.Table,
+    idio_vol: pa.Table,
+    initial_lambda: float | None = None,
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    alphas = partition_by_date(alphas)
+    benchmark_weights = partition_by_date(benchmark_weights)
+    factor_loadings = partition_by_date(factor_loadings)
+    factor_covariances = partition_by_date(factor_covariances)
+    idio_vol = partition_by_date(idio_vol)
+
+    weights_list = []
+    metrics_list = []
+    previous_weights = None
+    previous_lambda = initial_lambda
+    for date_ in dates:
+        alphas_slice = alphas[(date_,)].sort("ticker")
+        tickers = alphas_slice["ticker"].unique().sort().to_list()
+
+        covariance_matrix = get_risk_model(
+            tickers=tickers,
+            factor_loadings=factor_loadings[(date_,)].sort("ticker"),
+            factor_covariances=factor_covariances[(date_,)].sort("factor_1"),
+            idio_vol=idio_vol[(date_,)].sort("ticker"),
+            mode=RISK_MODEL,
+        )
+
+        # Consecutive dates in a batch warm start from each other
+        optimal_weights, lambda_, active_risk, method = get_optimal_weights_dynamic(
+            alphas=alphas_slice,
+            covariance_matrix=covariance_matrix,
+            benchmark_weights=benchmark_weights[(date_,)].sort("ticker"),
+            target_active_risk=TARGET_ACTIVE_RISK,
+            initial_lambda=previous_lambda,
+            initial_weights=previous_weights,
+            method=OPTIMIZER,
+        )
+
+        weights_list.append(optimal_weights.with_columns(pl.lit(date_).alias("date")))
+        metrics_list.append(
+            pl.DataFrame(
+                {
+                    "lambda": [lambda_],
+                    "active_risk": [active_risk],
+                    "date": [str(date_)],
+                    "method": [method],
+                }
+            )
+        )
+
+        previous_weights = optimal_weights
+
+        # Only a lambda from the search is a starting point for the next search
+        if method == "lambda_search":
+            previous_lambda = lambda_
+
+    return pl.concat(weights_list), pl.concat(metrics_list)
 
 
 @task
@@ -68,24 +122,34 @@ def get_portfolio_weights_for_date(
     factor_loadings: pl.DataFrame,
     factor_covariances: pl.DataFrame,
     idio_vol: pl.DataFrame,
+    initial_lambda: float | None = None,
+    initial_weights: pl.DataFrame | None = None,
 ) -> pl.DataFrame:
     tickers = alphas["ticker"].unique().sort().to_list()
-    covariance_matirx = get_covariance_matrix(
-        tickers, factor_loadings, factor_covariances, idio_vol
+    covariance_matirx = get_risk_model(
+        tickers, factor_loadings, factor_covariances, idio_vol, mode=RISK_MODEL
     )
 
-    optimal_weights, lambda_, active_risk = get_optimal_weights_dynamic(
+    optimal_weights, lambda_, active_risk, method = get_optimal_weights_dynamic(
         alphas=alphas,
         covariance_matrix=covariance_matirx,
         benchmark_weights=benchmark_weights,
         target_active_risk=TARGET_ACTIVE_RISK,
+        initial_lambda=initial_lambda,
+        initial_weights=initial_weights,
+        method=OPTIMIZER,
     )
 
     weights_df = optimal_weights.with_columns(
         pl.lit(date_).alias("date"), pl.lit(date_.year).alias("year")
     )
     metrics_df = pl.DataFrame(
-        {"lambda": [lambda_], "active_risk": [active_risk], "date": [str(date_)]}
+        {
+            "lambda": [lambda_],
+            "active_risk": [active_risk],
+            "date": [str(date_)],
+            "method": [method],
+        }
     )
 
     return weights_df, metrics_df
@@ -98,7 +162,8 @@ def get_portfolio_weights_history(
     factor_loadings: pl.DataFrame,
     factor_covariances: pl.DataFrame,
     idio_vol: pl.DataFrame,
-) -> tuple[pl.DataFrame]:
+    initial_lambdas: dict[dt.date, float],
+) -> pl.DataFrame:
     ray.init(
         dashboard_host="0.0.0.0",
         dashboard_port=8265,
@@ -107,50 +172,75 @@ def get_portfolio_weights_history(
     )
 
     dates = alphas["date"].unique().sort().to_list()
+    batches = get_date_batches(dates, BATCH_SIZE)
+
+    # Each task only receives the Arrow slices for its own dates
+    inputs = zip(
+        partition_by_batch(alphas, batches),
+        partition_by_batch(benchmark_weights, batches),
+        partition_by_batch(factor_loadings, batches),
+        partition_by_batch(factor_covariances, batches),
+        partition_by_batch(idio_vol, batches),
+    )
 
-    # Put DataFrames in Ray's object store once to avoid repeated serialization
-    alphas_ref = ray.put(alphas)
-    benchmark_weights_ref = ray.put(benchmark_weights)
-    factor_loadings_ref = ray.put(factor_loadings)
-    factor_covariances_ref = ray.put(factor_covariances)
-    idio_vol_ref = ray.put(idio_vol)
-
-    # Create futures for parallel processing
-    futures = [
-        get_portfolio_weights_for_date_parallel.remote(
-            date_,
-            alphas_ref,
-            benchmark_weights_ref,
-            factor_loadings_ref,
-            factor_covariances_ref,
-            idio_vol_ref,
+    pending = [
+        get_portfolio_weights_for_batch_parallel.remote(
+            batch,
+            *batch_inputs,
+            initial_lambdas.get(batch[0]),
         )
-        for date_ in dates
+        for batch, batch_inputs in zip(batches, inputs)
     ]
 
-    # Get results
-    results = ray.get(futures)
+    bear_lake_client = get_bear_lake_client()
+    create_portfolio_weights_table(bear_lake_client)
 
-    # Unpack results
-    weights_list = [r[0] for r in results]
-    metrics_list = [r[1] for r in results]
+    # Write weights as batches finish so only a bounded chunk is held in memory
+    weights_chunk = []
+    weights_chunk_size = 0
+    metrics_list = []
+    while pending:
+        ready, pending = ray.wait(pending, num_returns=1)
+        weights_df, metrics_df = ray.get(ready[0])
 
-    weights_df = pl.concat(weights_list).with_columns(
-        pl.col("date").dt.year().alias("year")
-    )
-    metrics_df = pl.concat(metrics_list)
+        weights_chunk.append(weights_df)
+        weights_chunk_size += len(weights_df)
+        metrics_list.append(metrics_df)
 
-    return weights_df, metrics_df
+        if weights_chunk_size >= WRITE_CHUNK_SIZE or not pending:
+            upsert_portfolio_weights(bear_lake_client, pl.concat(weights_chunk))
+            weights_chunk = []
+            weights_chunk_size = 0
+
+    return pl.concat(metrics_list).sort("date")
 
 
 @task
-def upload_and_merge_portfolio_weights(portfolio_weights: pl.DataFrame):
+def get_initial_lambdas(start: dt.date, end: dt.date) -> dict[dt.date, float]:
     bear_lake_client = get_bear_lake_client()
-    table_name = "portfolio_weights"
 
+    if "portfolio_metrics" not in bear_lake_client.list_tables():
+        return {}
+
+    create_portfolio_metrics_table(bear_lake_client)
+
+    # Each date starts its lambda search from the last lambda the search found
+    # before it, the risk target's lambda penalizes active rather than total risk
+    portfolio_metrics = get_portfolio_metrics(start, end).select(
+        "date",
+        pl.when(pl.col("method").eq("lambda_search"))
+        .then(pl.col("lambda"))
+        .shift(1)
+        .forward_fill(),
+    )
+
+    return dict(portfolio_metrics.drop_nulls().iter_rows())
+
+
+def create_portfolio_weights_table(bear_lake_client: bl.Database):
     # Create table if not exists
     bear_lake_client.create(
-        name=table_name,
+        name="portfolio_weights",
         schema={
             "ticker": pl.String,
             "date": pl.Date,
@@ -162,32 +252,68 @@ def upload_and_merge_portfolio_weights(portfolio_weights: pl.DataFrame):
         mode="skip",
     )
 
-    # Insert into table
-    bear_lake_client.insert(name=table_name, data=portfolio_weights, mode="append")
 
-    # Optimize table (deduplicate)
-    bear_lake_client.optimize(name=table_name)
+def upsert_portfolio_weights(
+    bear_lake_client: bl.Database, portfolio_weights: pl.DataFrame
+):
+    portfolio_weights = portfolio_weights.with_columns(
+        pl.col("date").dt.year().cast(pl.Int32).alias("year")
+    )
+    bear_lake_client.upsert(name="portfolio_weights", data=portfolio_weights)
 
 
 @task
-def upload_and_merge_portfolio_metrics(portfolio_metrics: pl.DataFrame):
+def upload_and_merge_portfolio_weights(portfolio_weights: pl.DataFrame):
     bear_lake_client = get_bear_lake_client()
+    create_portfolio_weights_table(bear_lake_client)
+
+    # Upsert into table
+    upsert_portfolio_weights(bear_lake_client, portfolio_weights)
+
+
+def create_portfolio_metrics_table(bear_lake_client: bl.Database):
     table_name = "portfolio_metrics"
+    schema = {
+        "date": pl.Date,
+        "lambda": pl.Float64,
+        "active_risk": pl.Float64,
+        "method": pl.String,
+    }
 
     # Create table if not exists
     bear_lake_client.create(
         name=table_name,
-        schema={"date": pl.Date, "lambda": pl.Float64, "active_risk": pl.Float64},
+        schema=schema,
         partition_keys=None,
         primary_keys=["date"],
         mode="skip",
     )
 
-    # Insert into table
-    bear_lake_client.insert(name=table_name, data=portfolio_metrics, mode="append")
+    # Tables from before the method was recorded keep their rows with a null
+    # method, since which of them came from the lambda search is unknown
+    if "method" not in bear_lake_client.get_schema(table_name):
+        existing = bear_lake_client.query(
+            bear_lake_client.table(table_name).with_columns(
+                pl.lit(None, pl.String).alias("method")
+            )
+        )
+        bear_lake_client.create(
+            name=table_name,
+            schema=schema,
+            partition_keys=None,
+            primary_keys=["date"],
+            mode="replace",
+        )
+        bear_lake_client.insert(name=table_name, data=existing)
+
+
+@task
+def upload_and_merge_portfolio_metrics(portfolio_metrics: pl.DataFrame):
+    bear_lake_client = get_bear_lake_client()
+    create_portfolio_metrics_table(bear_lake_client)
 
-    # Optimize table (deduplicate)
-    bear_lake_client.optimize(name=table_name)
+    # Upsert into table
+    bear_lake_client.upsert(name="portfolio_metrics", data=portfolio_metrics)
 
 
 @flow
@@ -195,17 +321,26 @@ def portfolio_weights_backfill_flow():
     start = dt.date(2022, 7, 29)
     end = dt.date.today() - dt.timedelta(days=1)
 
-    alphas = get_alphas(start, end)
-    benchmark_weights = get_benchmark_weights(start, end)
-    factor_loadings = get_factor_loadings(start, end)
-    factor_covariances = get_factor_covariances(start, end)
-    idio_vol = get_idio_vol(start, end)
-
-    portfolio_weights, portfolio_metrics = get_portfolio_weights_history(
-        alphas, benchmark_weights, factor_loadings, factor_covariances, idio_vol
+    alphas, benchmark_weights, factor_loadings, factor_covariances, idio_vol = (
+        get_model_snapshot(
+            start,
+            end,
+            benchmark=BENCHMARK,
+            cached_benchmark_weights=CACHE_BENCHMARK_WEIGHTS,
+        )
+    )
+    initial_lambdas = get_initial_lambdas(start, end)
+
+    # Weights are written to the table in chunks as they are computed
+    portfolio_metrics = get_portfolio_weights_history(
+        alphas,
+        benchmark_weights,
+        factor_loadings,
+        factor_covariances,
+        idio_vol,
+        initial_lambdas,
     )
 
-    upload_and_merge_portfolio_weights(portfolio_weights)
     upload_and_merge_portfolio_metrics(portfolio_metrics)
 
 
@@ -221,11 +356,26 @@ def portfolio_weights_daily_flow():
         print("Yesterday:", yesterday)
         return
 
-    alphas = get_alphas(last_market_date, last_market_date)
-    benchmark_weights = get_benchmark_weights(last_market_date, last_market_date)
-    factor_loadings = get_factor_loadings(last_market_date, last_market_date)
-    factor_covariances = get_factor_covariances(last_market_date, last_market_date)
-    idio_vol = get_idio_vol(last_market_date, last_market_date)
+    alphas, benchmark_weights, factor_loadings, factor_covariances, idio_vol = (
+        get_model_snapshot(
+            last_market_date,
+            last_market_date,
+            benchmark=BENCHMARK,
+            cached_benchmark_weights=CACHE_BENCHMARK_WEIGHTS,
+        )
+    )
+
+    # Warm start from the previous market date's solution
+    previous_market_date = get_trading_date_range(window=2)["date"].min()
+    previous_weights = get_portfolio_weights(previous_market_date, previous_market_date)
+    create_portfolio_metrics_table(get_bear_lake_client())
+    previous_metrics = get_portfolio_metrics(previous_market_date, previous_market_date)
+    previous_lambda = (
+        previous_metrics["lambda"][0]
+        if len(previous_metrics) > 0
+        and previous_metrics["method"][0] == "lambda_search"
+        else None
+    )
 
     portfolio_weights, portfolio_metrics = get_portfolio_weights_for_date(
         date_=last_market_date,
@@ -234,6 +384,8 @@ def portfolio_weights_daily_flow():
         factor_loadings=factor_loadings,
         factor_covariances=factor_covariances,
         idio_vol=idio_vol,
+        initial_lambda=previous_lambda,
+        initial_weights=previous_weights if len(previous_weights) > 0 else None,
     )
 
     upload_and_merge_portfolio_weights(portfolio_weights)
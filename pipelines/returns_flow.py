@@ -1,18 +1,23 @@
+import datetime as dt
+
 import bear_lake as bl
 import polars as pl
 from clients import get_bear_lake_client
 from prefect import flow, task
+from utils import publish_dataset
+from variables import RESTATEMENT_WINDOW_DAYS
 
+RETURNS_SCHEMA = {
+    "ticker": pl.String,
+    "date": pl.Date,
+    "year": pl.Int32,
+    "return": pl.Float64,
+}
 
-@task
-def materialize_stock_returns():
-    bear_lake_client = get_bear_lake_client()
-    table_name = "stock_returns"
 
-    # Get stock returns
-    stock_returns = bear_lake_client.query(
-        bl.table("stock_prices")
-        .sort("ticker", "date")
+def calculate_returns(prices: pl.LazyFrame) -> pl.LazyFrame:
+    return (
+        prices.sort("ticker", "date")
         .select(
             "ticker",
             "date",
@@ -23,62 +28,147 @@ def materialize_stock_returns():
         .sort("ticker", "date")
     )
 
+
+def returns_restated(recomputed: pl.DataFrame, stored: pl.DataFrame) -> bool:
+    # Any stored return that no longer matches the prices (or is missing) means
+    # the prices were restated or backfilled underneath us
+    mismatches = recomputed.join(
+        other=stored, on=["ticker", "date"], how="left", suffix="_stored"
+    ).filter(
+        pl.col("return_stored").is_null()
+        | pl.col("return").sub(pl.col("return_stored")).abs().gt(1e-12)
+    )
+
+    return len(mismatches) > 0
+
+
+def rebuild_returns(prices_table: str, returns_table: str):
+    bear_lake_client = get_bear_lake_client()
+
+    # Get returns
+    returns = bear_lake_client.query(calculate_returns(bl.table(prices_table)))
+
     # Create or replace table
     bear_lake_client.create(
-        name=table_name,
-        schema={
-            "ticker": pl.String,
-            "date": pl.Date,
-            "year": pl.Int32,
-            "return": pl.Float64,
-        },
+        name=returns_table,
+        schema=RETURNS_SCHEMA,
         partition_keys=["year"],
         primary_keys=["ticker", "date"],
         mode="replace",
     )
 
     # Insert data
-    bear_lake_client.insert(name=table_name, data=stock_returns, mode="append")
+    bear_lake_client.insert(name=returns_table, data=returns, mode="append")
 
+    # Downstream stages of the run read the whole table from memory
+    publish_dataset(returns_table, returns)
 
-@task
-def materialize_etf_returns():
+
+def materialize_returns(prices_table: str, returns_table: str, full_refresh: bool):
     bear_lake_client = get_bear_lake_client()
-    table_name = "etf_returns"
 
-    # Get stock returns
-    stock_returns = bear_lake_client.query(
-        bl.table("etf_prices")
-        .sort("ticker", "date")
-        .select(
-            "ticker",
-            "date",
-            pl.col("date").dt.year().alias("year"),
-            pl.col("close").pct_change().over("ticker").alias("return"),
+    if full_refresh or returns_table not in bear_lake_client.list_tables():
+        rebuild_returns(prices_table, returns_table)
+        return
+
+    watermark = bear_lake_client.query(
+        bl.table(returns_table).select(pl.col("date").max())
+    )["date"][0]
+
+    if watermark is None:
+        rebuild_returns(prices_table, returns_table)
+        return
+
+    # The previous close of every ticker lives in the watermark's year or the one
+    # before it, so older partitions never need to be read
+    lookback_start = dt.date(watermark.year - 1, 1, 1)
+
+    # Split and dividend adjustments scale a ticker's whole price history, which
+    # leaves its returns unchanged, so restatements are only looked for in a
+    # short trailing window
+    check_start = watermark - dt.timedelta(days=RESTATEMENT_WINDOW_DAYS)
+
+    prices = bear_lake_client.query(
+        bl.table(prices_table)
+        .filter(pl.col("date") >= check_start)
+        .select("ticker", "date", "close")
+    )
+
+    # Tickers that didn't trade in the window take their previous close from
+    # further back
+    gap_tickers = (
+        prices.group_by("ticker")
+        .agg(pl.col("date").min())
+        .filter(pl.col("date") > watermark)["ticker"]
+    )
+    if len(gap_tickers) > 0:
+        previous_closes = bear_lake_client.query(
+            bl.table(prices_table)
+            .filter(
+                pl.col("date").is_between(lookback_start, check_start, closed="left"),
+                pl.col("ticker").is_in(gap_tickers.to_list()),
+            )
+            .select("ticker", "date", "close")
+            .sort("date")
+            .group_by("ticker")
+            .last()
         )
-        .drop_nulls()
-        .sort("ticker", "date")
+        prices = pl.concat([previous_closes, prices])
+
+    returns = bear_lake_client.query(calculate_returns(prices.lazy()))
+
+    # Read from lookback_start for the published dataset, which downstream stages
+    # of the run use for their windows
+    stored_returns = bear_lake_client.query(
+        bl.table(returns_table)
+        .filter(pl.col("date") >= lookback_start)
+        .select(RETURNS_SCHEMA.keys())
     )
 
-    # Create or replace table
-    bear_lake_client.create(
-        name=table_name,
-        schema={
-            "ticker": pl.String,
-            "date": pl.Date,
-            "year": pl.Int32,
-            "return": pl.Float64,
-        },
-        partition_keys=["year"],
-        primary_keys=["ticker", "date"],
-        mode="replace",
+    if returns_restated(
+        returns.filter(pl.col("date") <= watermark),
+        stored_returns.filter(pl.col("date") >= check_start),
+    ):
+        print(f"{prices_table} was restated, rebuilding {returns_table}!")
+        rebuild_returns(prices_table, returns_table)
+        return
+
+    new_returns = returns.filter(pl.col("date") > watermark)
+
+    if len(new_returns) > 0:
+        # Insert data (only the partitions of the new dates are rewritten)
+        bear_lake_client.insert(name=returns_table, data=new_returns, mode="append")
+    else:
+        print(f"No new {prices_table} since {watermark}!")
+
+    # The stored rows plus the new ones are the table from lookback_start on, so
+    # downstream stages of the run can read that range from memory. The
+    # recomputed returns can't stand in for the stored rows, as they have no
+    # return for the first price of each ticker in the range.
+    publish_dataset(
+        returns_table,
+        pl.concat([stored_returns, new_returns]).sort("ticker", "date"),
+        start=lookback_start,
     )
 
-    # Insert data
-    bear_lake_client.insert(name=table_name, data=stock_returns, mode="append")
+
+@task
+def materialize_stock_returns(full_refresh: bool = False):
+    materialize_returns("stock_prices", "stock_returns", full_refresh)
+
+
+@task
+def materialize_etf_returns(full_refresh: bool = False):
+    materialize_returns("etf_prices", "etf_returns", full_refresh)
 
 
 @flow
 def returns_backfill_flow():
+    materialize_stock_returns(full_refresh=True)
+    materialize_etf_returns(full_refresh=True)
+
+
+@flow
+def returns_daily_flow():
     materialize_stock_returns()
     materialize_etf_returns()
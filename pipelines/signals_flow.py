@@ -0,0 +1,166 @@
+import datetime as dt
+
+import polars as pl
+from clients import get_bear_lake_client
+from prefect import flow, task
+from utils import (compute_signals, filter_universe, get_signal_lookback,
+                   get_trading_date_range, register_signal, scan_table)
+from variables import IC, NEUTRALIZE_SIGNALS, PROFILE_SIGNALS
+
+# Signals are declared over the columns of get_signal_inputs and evaluated per
+# ticker in date order, with the trading days of history they need
+register_signal(
+    "reversal", pl.col("return").log1p().rolling_sum(21).mul(-1), lookback=21
+)
+
+
+def get_signal_inputs(start: dt.date, end: dt.date) -> pl.LazyFrame:
+    return scan_table("stock_returns", start, end, ["ticker", "date", "return"]).join(
+        other=filter_universe("idio_vol", start, end, ["idio_vol"]).filter(
+            pl.col("idio_vol").is_not_null()
+        ),
+        on=["ticker", "date"],
+        how="left",
+    )
+
+
+def get_signal_factor_loadings(start: dt.date, end: dt.date) -> pl.LazyFrame:
+    return filter_universe("factor_loadings", start, end, ["factor", "loading"]).filter(
+        pl.col("loading").is_not_null()
+    )
+
+
+@task
+def calculate_signals(
+    start: dt.date, end: dt.date
+) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    results = compute_signals(
+        get_signal_inputs(start, end),
+        ic=IC,
+        profile=PROFILE_SIGNALS,
+        factor_loadings=(
+            get_signal_factor_loadings(start, end) if NEUTRALIZE_SIGNALS else None
+        ),
+    )
+
+    # Values without factor loadings to neutralize against have no score
+    scored = results.filter(pl.col("score").is_not_null())
+
+    signals = results.select("ticker", "date", "year", "signal", "value")
+    scores = scored.select("ticker", "date", "year", "signal", "score")
+    alphas = scored.select("ticker", "date", "year", "signal", "alpha")
+
+    return signals, scores, alphas
+
+
+@task
+def upload_and_merge_signals(signals: pl.DataFrame) -> pl.DataFrame:
+    bear_lake_client = get_bear_lake_client()
+    table_name = "signals"
+
+    # Create table if not exists
+    bear_lake_client.create(
+        name=table_name,
+        schema={
+            "ticker": pl.String,
+            "date": pl.Date,
+            "year": pl.Int32,
+            "signal": pl.String,
+            "value": pl.Float64,
+        },
+        partition_keys=["year"],
+        primary_keys=["ticker", "date", "signal"],
+        mode="skip",
+    )
+
+    # Insert
+    bear_lake_client.upsert(name=table_name, data=signals)
+
+
+@task
+def upload_and_merge_scores(scores: pl.DataFrame) -> pl.DataFrame:
+    bear_lake_client = get_bear_lake_client()
+    table_name = "scores"
+
+    # Create table if not exists
+    bear_lake_client.create(
+        name=table_name,
+        schema={
+            "ticker": pl.String,
+            "date": pl.Date,
+            "year": pl.Int32,
+            "signal": pl.String,
+            "score": pl.Float64,
+        },
+        partition_keys=["year"],
+        primary_keys=["ticker", "date", "signal"],
+        mode="skip",
+    )
+
+    # Insert
+    bear_lake_client.upsert(name=table_name, data=scores)
+
+
+@task
+def upload_and_merge_alphas(alphas: pl.DataFrame) -> pl.DataFrame:
+    bear_lake_client = get_bear_lake_client()
+    table_name = "alphas"
+
+    # Create table if not exists
+    bear_lake_client.create(
+        name=table_name,
+        schema={
+            "ticker": pl.String,
+            "date": pl.Date,
+            "year": pl.Int32,
+            "signal": pl.String,
+            "alpha": pl.Float64,
+        },
+        partition_keys=["year"],
+        primary_keys=["ticker", "date", "signal"],
+        mode="skip",
+    )
+
+    # Insert
+    bear_lake_client.upsert(name=table_name, data=alphas)
+
+
+@flow
+def signals_backfill_flow():
+    start = dt.date(2020, 7, 28)
+    end = dt.date.today() - dt.timedelta(days=1)
+
+    signals, scores, alphas = calculate_signals(start, end)
+
+    upload_and_merge_signals(signals)
+    upload_and_merge_scores(scores)
+    upload_and_merge_alphas(alphas)
+
+
+@flow
+def signals_daily_flow():
+    # Enough history for the signal with the longest lookback
+    date_range = get_trading_date_range(window=get_signal_lookback())
+
+    start = date_range["date"].min()
+    end = date_range["date"].max()
+
+    yesterday = dt.date.today() - dt.timedelta(days=1)
+
+    # Only get new data if yesterday was the last market date
+    if end != yesterday:
+        print("Market was not open yesterday!")
+        print("Last Market Date:", end)
+        print("Yesterday:", yesterday)
+        return
+
+    signals, scores, alphas = (
+        df.filter(pl.col("date").eq(end)) for df in calculate_signals(start, end)
+    )
+
+    if not (len(signals) > 0 and len(scores) > 0 and len(alphas) > 0):
+        raise ValueError("No values found!")
+
+    upload_and_merge_signals(signals)
+    upload_and_merge_scores(scores)
+    upload_and_merge_alphas(alphas)
@@ -1,5 +1,8 @@
+import datetime as dt
+import hashlib
 import io
 import os
+import time
 
 import bear_lake as bl
 import pandas as pd
@@ -12,8 +15,34 @@ from prefect import flow, task
 load_dotenv()
 
 
+UNIVERSE_SOURCE_SCHEMA = {
+    "etag": pl.String,
+    "content_hash": pl.String,
+    "refreshed_at": pl.Datetime,
+}
+
+
+@task
+def get_universe_source() -> dict | None:
+    # ETag and content hash of the Wikipedia data the universe was last built from
+    bear_lake_client = get_bear_lake_client()
+    tables = bear_lake_client.list_tables()
+
+    if "universe_source" not in tables or "universe_intervals" not in tables:
+        return None
+
+    universe_source = bear_lake_client.query(bl.table("universe_source"))
+    return universe_source.row(0, named=True) if len(universe_source) > 0 else None
+
+
 @task
-def get_wikipedia_data() -> tuple[pd.DataFrame]:
+def get_wikipedia_data(
+    etag: str | None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame, str | None] | None:
+    """
+    Current constituents and constituent changes tables, plus the page's ETag.
+    Returns None without downloading the page if it still matches the ETag.
+    """
     # Get Wikipedia user agent
     wikipedia_user_agent = os.getenv("WIKIPEDIA_USER_AGENT")
 
@@ -24,7 +53,14 @@ def get_wikipedia_data() -> tuple[pd.DataFrame]:
     wikipedia_url = "https://en.wikipedia.org/wiki/List_of_S%26P_500_companies"
     headers = {"User-Agent": wikipedia_user_agent}
 
+    if etag is not None:
+        headers["If-None-Match"] = etag
+
     response = requests.get(wikipedia_url, headers=headers)
+
+    if response.status_code == 304:
+        return None
+
     response.raise_for_status()
 
     # Read the HTML tables from Wikipedia
@@ -32,13 +68,22 @@ def get_wikipedia_data() -> tuple[pd.DataFrame]:
         io.StringIO(response.text)
     )
 
-    return current_constituents_df, constituent_changes_df
+    return current_constituents_df, constituent_changes_df, response.headers.get("ETag")
 
 
-@task
-def get_calendar_data() -> pl.DataFrame:
-    bear_lake_client = get_bear_lake_client()
-    return bear_lake_client.query(bl.table("calendar"))
+def get_content_hash(
+    current_constituents_df: pl.DataFrame, constituent_changes_df: pl.DataFrame
+) -> str:
+    # Only the columns the universe is built from, so edits to e.g. the reasons
+    # or company names don't trigger a rebuild
+    content_hash = hashlib.sha256()
+    content_hash.update(current_constituents_df.select("ticker").write_csv().encode())
+    content_hash.update(
+        constituent_changes_df.select("effective_date", "ticker", "action")
+        .write_csv()
+        .encode()
+    )
+    return content_hash.hexdigest()
 
 
 @task
@@ -79,64 +124,92 @@ def clean_constituent_changes_df(constituent_changes_df: pd.DataFrame) -> pl.Dat
 
 
 @task
-def construct_universe(
-    current_constituents_df: pl.DataFrame,
-    constituent_changes_df: pl.DataFrame,
-    calendar_df: pl.DataFrame,
+def construct_universe_intervals(
+    current_constituents_df: pl.DataFrame, constituent_changes_df: pl.DataFrame
 ) -> pl.DataFrame:
-    # Start with current constituents as a set
-    constituents = set(current_constituents_df["ticker"].to_list())
-
-    # Get sorted calendar dates (descending)
-    calendar_dates = sorted(calendar_df["date"].to_list(), reverse=True)
+    """
+    Membership intervals (ticker, start_date, end_date), inclusive on both ends.
+    A null start_date means a member since before the first recorded change and
+    a null end_date a current member.
+
+    Walking back from the current constituents, a ticker was a member right
+    before a change if and only if the change removed it, so every change fixes
+    the ticker's membership from its previous change up to the day before.
+    """
+    current_tickers = current_constituents_df["ticker"].unique()
+
+    # The last action wins if a ticker was added and removed on the same date
+    changes = constituent_changes_df.group_by(
+        "ticker", "effective_date", maintain_order=True
+    ).agg(pl.col("action").last())
+
+    # One row per change plus one per ticker for its current membership
+    events = pl.concat(
+        [
+            changes.select(
+                "ticker",
+                pl.col("effective_date").alias("date"),
+                pl.col("action").eq("Removed").alias("member_before"),
+            ),
+            pl.concat([changes["ticker"], current_tickers])
+            .unique()
+            .to_frame()
+            .select(
+                "ticker",
+                pl.lit(None, pl.Date).alias("date"),
+                pl.col("ticker").is_in(current_tickers).alias("member_before"),
+            ),
+        ]
+    ).sort("ticker", "date", nulls_last=True)
+
+    segments = events.select(
+        "ticker",
+        pl.col("date").shift(1).over("ticker").alias("start_date"),
+        pl.col("date").sub(pl.duration(days=1)).alias("end_date"),
+        pl.col("member_before").alias("member"),
+    )
 
-    # Group changes by date for efficient lookup
-    changes_by_date = constituent_changes_df.group_by("effective_date").agg(
-        [pl.col("ticker"), pl.col("action")]
+    # Merge back to back member segments (e.g. a repeated removal) into one
+    return (
+        segments.with_columns(
+            pl.col("member")
+            .ne(pl.col("member").shift(1))
+            .fill_null(True)
+            .cum_sum()
+            .over("ticker")
+            .alias("island")
+        )
+        .filter("member")
+        .group_by("ticker", "island")
+        .agg(pl.col("start_date").first(), pl.col("end_date").last())
+        .select("ticker", "start_date", "end_date")
+        .sort("ticker", "start_date", nulls_last=False)
     )
-    changes_dict = {
-        row["effective_date"]: {"tickers": row["ticker"], "actions": row["action"]}
-        for row in changes_by_date.iter_rows(named=True)
-    }
 
-    # Store results as we iterate backwards
-    snapshots = []
 
-    for date in calendar_dates:
-        # Record current state
-        snapshots.append(
-            {
-                "date": date,
-                "ticker": sorted(list(constituents)),  # Sort for consistency
-            }
-        )
+@task
+def upload_universe_intervals(universe_intervals: pl.DataFrame):
+    table_name = "universe_intervals"
 
-        # Apply changes for this date in reverse
-        if date in changes_dict:
-            tickers = changes_dict[date]["tickers"]
-            actions = changes_dict[date]["actions"]
-
-            for ticker, action in zip(tickers, actions):
-                if action == "Added":
-                    # If it was added on this date, remove it (going backwards)
-                    constituents.discard(ticker)
-                elif action == "Removed":
-                    # If it was removed on this date, add it back (going backwards)
-                    constituents.add(ticker)
-
-    universe_df = (
-        pl.DataFrame(snapshots)
-        .explode("ticker")
-        .with_columns(pl.col("date").dt.year().alias("year"))
-        .sort("date", "ticker")
+    # Get ClickHouse client
+    bear_lake_client = get_bear_lake_client()
+
+    # Create
+    bear_lake_client.create(
+        name=table_name,
+        schema={"ticker": pl.String, "start_date": pl.Date, "end_date": pl.Date},
+        partition_keys=None,
+        primary_keys=["ticker", "start_date"],
+        mode="replace",
     )
 
-    return universe_df
+    # Insert
+    bear_lake_client.insert(name=table_name, data=universe_intervals, mode="append")
 
 
 @task
-def upload_universe_df(universe_df: pl.DataFrame):
-    table_name = "universe"
+def upload_universe_source(etag: str | None, content_hash: str):
+    table_name = "universe_source"
 
     # Get ClickHouse client
     bear_lake_client = get_bear_lake_client()
@@ -144,28 +217,78 @@ def upload_universe_df(universe_df: pl.DataFrame):
     # Create
     bear_lake_client.create(
         name=table_name,
-        schema={"date": pl.Date, "year": pl.Int32, "ticker": pl.String},
-        partition_keys=["year"],
-        primary_keys=["date", "ticker"],
+        schema=UNIVERSE_SOURCE_SCHEMA,
+        partition_keys=None,
+        primary_keys=["content_hash"],
         mode="replace",
     )
 
     # Insert
-    bear_lake_client.insert(name=table_name, data=universe_df, mode="append")
+    bear_lake_client.insert(
+        name=table_name,
+        data=pl.DataFrame(
+            {
+                "etag": [etag],
+                "content_hash": [content_hash],
+                "refreshed_at": [dt.datetime.now()],
+            },
+            schema=UNIVERSE_SOURCE_SCHEMA,
+        ),
+        mode="append",
+    )
 
 
 @flow
-def universe_backfill_flow():
-    current_constituents_df, constituent_changes_df = get_wikipedia_data()
-    calendar_df = get_calendar_data()
+def universe_backfill_flow(full_refresh: bool = False) -> dict:
+    """
+    Rebuild the universe only if the constituent tables on Wikipedia changed
+    since the last build (or on a full refresh). The intervals are open ended,
+    so an unchanged universe needs no write at all.
+    """
+    start = time.perf_counter()
+    universe_source = None if full_refresh else get_universe_source()
+
+    def report(rebuilt: bool, reason: str) -> dict:
+        refresh = {
+            "rebuilt": rebuilt,
+            "reason": reason,
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+        print("Universe refresh:", refresh)
+        return refresh
+
+    wikipedia_data = get_wikipedia_data(
+        universe_source["etag"] if universe_source is not None else None
+    )
+
+    if wikipedia_data is None:
+        return report(rebuilt=False, reason="page not modified")
+
+    current_constituents_df, constituent_changes_df, etag = wikipedia_data
 
     current_constituents_df_clean = clean_current_constituents_df(
         current_constituents_df
     )
     constituent_changes_df_clean = clean_constituent_changes_df(constituent_changes_df)
 
-    universe_df = construct_universe(
-        current_constituents_df_clean, constituent_changes_df_clean, calendar_df
+    content_hash = get_content_hash(
+        current_constituents_df_clean, constituent_changes_df_clean
     )
 
-    upload_universe_df(universe_df)
+    if universe_source is not None and universe_source["content_hash"] == content_hash:
+        # Keep the new ETag so the next run can skip the download
+        upload_universe_source(etag, content_hash)
+        return report(rebuilt=False, reason="constituents unchanged")
+
+    universe_intervals = construct_universe_intervals(
+        current_constituents_df_clean, constituent_changes_df_clean
+    )
+
+    upload_universe_intervals(universe_intervals)
+    upload_universe_source(etag, content_hash)
+
+    if full_refresh:
+        return report(rebuilt=True, reason="full refresh")
+    if universe_source is None:
+        return report(rebuilt=True, reason="no previous build")
+    return report(rebuilt=True, reason="constituents changed")
@@ -1,17 +1,34 @@
-from .calendar import get_last_market_date, get_trading_date_range
-from .covariance_matrix import get_covariance_matrix
-from .data import (get_alphas, get_benchmark_returns, get_benchmark_weights,
+from .bar_downloader import download_bars
+from .calendar import (get_last_market_date, get_trading_date_range,
+                       get_trading_days_since)
+from .covariance_matrix import (get_covariance_matrix, get_factor_risk_model,
+                                get_risk_model)
+from .cross_section import cross_sectional_zscore, neutralize, winsorize
+from .data import (expand_universe, explain_scan, filter_universe, get_alphas,
+                   get_benchmark_returns, get_benchmark_weights,
                    get_etf_returns, get_factor_covariances,
-                   get_factor_loadings, get_idio_vol, get_portfolio_weights,
-                   get_prices, get_stock_returns, get_universe,
-                   get_universe_returns)
+                   get_factor_loadings, get_idio_vol, get_model_snapshot,
+                   get_portfolio_metrics, get_portfolio_weights, get_prices,
+                   get_stock_returns, get_universe, get_universe_returns,
+                   scan_benchmark_weights, scan_table)
+from .datasets import dataset_scope, get_dataset_stats, publish_dataset
+from .operator_state import (apply_operators, build_operator_state,
+                             check_operator_state, get_operator_state,
+                             update_operator_state, upload_operator_state)
 from .portfolio import get_optimal_weights_dynamic
+from .rolling_covariance import rolling_covariances
+from .rolling_regression import (add_constant, group_sums, rolling_ols,
+                                 solve_windows, update_windowed_sums)
+from .signal_engine import (compute_signals, get_signal_lookback,
+                            profile_signals, register_signal)
 
 __all__ = [
     "get_universe_returns",
     "get_stock_returns",
     "get_etf_returns",
     "get_covariance_matrix",
+    "get_factor_risk_model",
+    "get_risk_model",
     "get_optimal_weights_dynamic",
     "get_alphas",
     "get_benchmark_weights",
@@ -19,9 +36,40 @@ __all__ = [
     "get_factor_covariances",
     "get_factor_loadings",
     "get_idio_vol",
+    "get_model_snapshot",
+    "get_portfolio_metrics",
     "get_portfolio_weights",
     "get_prices",
     "get_last_market_date",
     "get_trading_date_range",
+    "get_trading_days_since",
     "get_universe",
+    "explain_scan",
+    "expand_universe",
+    "add_constant",
+    "group_sums",
+    "rolling_covariances",
+    "rolling_ols",
+    "solve_windows",
+    "update_windowed_sums",
+    "download_bars",
+    "apply_operators",
+    "build_operator_state",
+    "update_operator_state",
+    "check_operator_state",
+    "get_operator_state",
+    "upload_operator_state",
+    "cross_sectional_zscore",
+    "winsorize",
+    "neutralize",
+    "register_signal",
+    "get_signal_lookback",
+    "compute_signals",
+    "profile_signals",
+    "scan_table",
+    "scan_benchmark_weights",
+    "filter_universe",
+    "dataset_scope",
+    "publish_dataset",
+    "get_dataset_stats",
 ]
@@ -0,0 +1,200 @@
+import datetime as dt
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import polars as pl
+import requests
+from alpaca.common.exceptions import APIError
+from alpaca.data.enums import Adjustment, DataFeed
+from alpaca.data.requests import StockBarsRequest
+from alpaca.data.timeframe import TimeFrame, TimeFrameUnit
+from clients import get_alpaca_historical_stock_data_client
+
+# Alpaca returns at most this many bars per page
+PAGE_LIMIT = 10_000
+
+# Basic data plan allows 200 requests per minute
+REQUESTS_PER_MINUTE = 200
+BURST = 10
+
+MAX_WORKERS = 8
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1.0
+
+TRADING_DAYS_PER_YEAR = 252
+
+BARS_SCHEMA = {
+    "ticker": pl.String,
+    "date": pl.Date,
+    "open": pl.Float64,
+    "high": pl.Float64,
+    "low": pl.Float64,
+    "close": pl.Float64,
+    "volume": pl.Float64,
+    "trade_count": pl.Float64,
+    "vwap": pl.Float64,
+}
+
+BarChunk = tuple[list[str], dt.datetime, dt.datetime]
+
+
+class TokenBucket:
+    """Thread-safe token bucket shared by every request in a download."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def get_year_spans(
+    start: dt.datetime, end: dt.datetime
+) -> list[tuple[dt.datetime, dt.datetime]]:
+    spans = []
+    for year in range(start.year, end.year + 1):
+        year_start = max(dt.datetime(year, 1, 1, tzinfo=start.tzinfo), start)
+        year_end = min(dt.datetime(year, 12, 31, 23, 59, 59, tzinfo=end.tzinfo), end)
+        spans.append((year_start, year_end))
+
+    return spans
+
+
+def plan_bar_requests(
+    tickers: list[str], start: dt.datetime, end: dt.datetime
+) -> list[BarChunk]:
+    """
+    Split the ticker x date space into chunks of calendar years and ticker
+    batches, each sized to fit the daily bars of its span in a single page.
+    """
+    chunks = []
+    for span_start, span_end in get_year_spans(start, end):
+        calendar_days = (span_end.date() - span_start.date()).days + 1
+        trading_days = math.ceil(calendar_days * TRADING_DAYS_PER_YEAR / 365)
+        batch_size = max(1, PAGE_LIMIT // trading_days)
+
+        for i in range(0, len(tickers), batch_size):
+            chunks.append((tickers[i : i + batch_size], span_start, span_end))
+
+    return chunks
+
+
+def clean_bars(bars: pl.DataFrame) -> pl.DataFrame:
+    return bars.select(
+        pl.col("symbol").alias("ticker"),
+        pl.col("timestamp").dt.date().alias("date"),
+        "open",
+        "high",
+        "low",
+        "close",
+        "volume",
+        "trade_count",
+        "vwap",
+    )
+
+
+def is_retryable(error: Exception) -> bool:
+    # Rate limits, server errors and dropped connections are transient. Anything
+    # else (e.g. a bad symbol or credentials) would fail the same way again.
+    if isinstance(error, APIError):
+        status_code = error.status_code
+        return status_code is not None and (status_code == 429 or status_code >= 500)
+
+    return isinstance(
+        error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    )
+
+
+def download_bars(
+    tickers: list[str], start: dt.datetime, end: dt.datetime
+) -> pl.DataFrame:
+    """
+    Download split-adjusted daily bars for every ticker between start and end.
+
+    Chunks from plan_bar_requests run concurrently on a thread pool behind a
+    shared rate limiter. Each chunk is retried with exponential backoff on rate
+    limits, server errors and connection errors, and fails fast on anything else.
+    """
+    chunks = plan_bar_requests(tickers, start, end)
+    rate_limiter = TokenBucket(REQUESTS_PER_MINUTE / 60, BURST)
+    counters = {"requests": 0, "retries": 0, "bars": 0}
+    counters_lock = threading.Lock()
+
+    # The Alpaca client wraps a requests session, so give each thread its own
+    local = threading.local()
+
+    def fetch_chunk(chunk: BarChunk) -> pl.DataFrame:
+        if not hasattr(local, "alpaca_client"):
+            local.alpaca_client = get_alpaca_historical_stock_data_client()
+
+        chunk_tickers, chunk_start, chunk_end = chunk
+        stock_bars_request = StockBarsRequest(
+            symbol_or_symbols=chunk_tickers,
+            start=chunk_start,
+            end=chunk_end,
+            timeframe=TimeFrame(1, TimeFrameUnit.Day),
+            adjustment=Adjustment.ALL,
+            feed=DataFeed.IEX,
+        )
+
+        for attempt in range(MAX_RETRIES + 1):
+            rate_limiter.acquire()
+            with counters_lock:
+                counters["requests"] += 1
+
+            try:
+                bars_raw = local.alpaca_client.get_stock_bars(stock_bars_request)
+                break
+            except Exception as error:
+                if attempt == MAX_RETRIES or not is_retryable(error):
+                    raise
+
+                with counters_lock:
+                    counters["retries"] += 1
+                time.sleep(BACKOFF_SECONDS * 2**attempt * (1 + random.random()))
+
+        if not len(bars_raw.df) > 0:
+            return pl.DataFrame(schema=BARS_SCHEMA)
+
+        bars = clean_bars(pl.from_pandas(bars_raw.df.reset_index()))
+        with counters_lock:
+            counters["bars"] += len(bars)
+
+        return bars
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(fetch_chunk, chunk) for chunk in chunks]
+        bars_list = [future.result() for future in as_completed(futures)]
+    elapsed = time.perf_counter() - start_time
+
+    print(
+        f"Downloaded {counters['bars']} bars in {len(chunks)} chunks "
+        f"({counters['requests']} requests, {counters['retries']} retries) "
+        f"in {elapsed:.1f}s ({counters['bars'] / max(elapsed, 1e-9):.0f} bars/s)"
+    )
+
+    return pl.concat(
+        [pl.DataFrame(schema=BARS_SCHEMA), *bars_list], how="vertical_relaxed"
+    )
@@ -0,0 +1,17 @@
+import polars as pl
+
+# (raw weight of each member, stock_prices columns it is computed from). Raw
+# weights are normalized to sum to one over the universe on each date, and a
+# member with a null raw weight gets a null weight.
+Benchmark = tuple[pl.Expr, list[str]]
+
+BENCHMARKS: dict[str, Benchmark] = {
+    "equal_weight": (pl.lit(1.0), []),
+}
+
+
+def get_benchmark(benchmark: str) -> Benchmark:
+    if benchmark not in BENCHMARKS:
+        raise ValueError(f"Unknown benchmark '{benchmark}'")
+
+    return BENCHMARKS[benchmark]
@@ -17,3 +17,11 @@ def get_trading_date_range(window: int) -> dt.date:
     return bear_lake_client.query(
         bl.table("calendar").sort("date", descending=True).select("date").head(window)
     )
+
+
+def get_trading_days_since(date_: dt.date) -> int:
+    # Trading dates after date_, up to and including the last market date
+    bear_lake_client = get_bear_lake_client()
+    return bear_lake_client.query(
+        bl.table("calendar").filter(pl.col("date") > date_).select(pl.len())
+    ).item()
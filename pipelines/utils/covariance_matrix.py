@@ -1,6 +1,9 @@
 import numpy as np
 import polars as pl
 
+# (factor exposures Lᵀ Bᵀ as K x N, idio vols as N)
+FactorRiskModel = tuple[np.ndarray, np.ndarray]
+
 
 def get_factor_loadings_matrix(
     tickers: list[str], factor_loadings: pl.DataFrame
@@ -23,14 +26,25 @@ def get_factor_covariance_matrix(factor_covariances: pl.DataFrame) -> np.ndarray
     )
 
 
-def get_idio_vol_matrix(tickers: list[str], idio_vol: pl.DataFrame) -> np.ndarray:
-    return np.diag(
+def get_idio_vol_vector(tickers: list[str], idio_vol: pl.DataFrame) -> np.ndarray:
+    return (
         idio_vol.filter(pl.col("ticker").is_in(tickers))
         .sort("ticker")["idio_vol"]
         .to_numpy()
     )
 
 
+def get_idio_vol_matrix(tickers: list[str], idio_vol: pl.DataFrame) -> np.ndarray:
+    return np.diag(get_idio_vol_vector(tickers, idio_vol))
+
+
+def get_factor_covariance_root(factor_covariance_matrix: np.ndarray) -> np.ndarray:
+    # L such that F = L Lᵀ. An eigendecomposition rather than a Cholesky so that
+    # a merely semi-definite (smoothed) factor covariance matrix still works
+    eigenvalues, eigenvectors = np.linalg.eigh(factor_covariance_matrix)
+    return eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+
+
 def construct_covariance_matrix(
     tickers: list[str],
     factor_loadings_matrix: np.ndarray,
@@ -66,3 +80,40 @@ def get_covariance_matrix(
     )
 
     return covariance_matrix
+
+
+def get_factor_risk_model(
+    tickers: list[str],
+    factor_loadings: pl.DataFrame,
+    factor_covariances: pl.DataFrame,
+    idio_vol: pl.DataFrame,
+) -> FactorRiskModel:
+    factor_loadings_matrix = get_factor_loadings_matrix(tickers, factor_loadings)
+    factor_covariance_root = get_factor_covariance_root(
+        get_factor_covariance_matrix(factor_covariances)
+    )
+    idio_vol_vector = get_idio_vol_vector(tickers, idio_vol)
+
+    # Risk is ‖Lᵀ Bᵀ w‖² + ‖D w‖², so only the K x N exposures are ever stored
+    factor_exposures = (factor_loadings_matrix @ factor_covariance_root).T
+
+    return factor_exposures, idio_vol_vector
+
+
+def get_risk_model(
+    tickers: list[str],
+    factor_loadings: pl.DataFrame,
+    factor_covariances: pl.DataFrame,
+    idio_vol: pl.DataFrame,
+    mode: str = "factor",
+) -> pl.DataFrame | FactorRiskModel:
+    if mode == "factor":
+        return get_factor_risk_model(
+            tickers, factor_loadings, factor_covariances, idio_vol
+        )
+    elif mode == "dense":
+        return get_covariance_matrix(
+            tickers, factor_loadings, factor_covariances, idio_vol
+        )
+    else:
+        raise ValueError(f"Invalid mode: '{mode}'. Must be 'factor' or 'dense'")
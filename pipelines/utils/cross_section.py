@@ -0,0 +1,82 @@
+import numpy as np
+import polars as pl
+
+from .rolling_regression import (add_constant, get_group_bounds, group_sums,
+                                 solve_windows)
+
+# Operators take an expression and the columns that define a cross section, and
+# are evaluated over every cross section at once with window expressions, so a
+# backfill over thousands of dates is still a single pass. Missing values are
+# left out of the statistics and stay missing.
+
+
+def cross_sectional_zscore(
+    expression: pl.Expr, by: str | list[str] = "date"
+) -> pl.Expr:
+    return expression.sub(expression.mean().over(by)).truediv(expression.std().over(by))
+
+
+def winsorize(
+    expression: pl.Expr,
+    lower: float = 0.01,
+    upper: float = 0.99,
+    by: str | list[str] = "date",
+) -> pl.Expr:
+    # Clip to the lower and upper quantiles of each cross section
+    return expression.clip(
+        expression.quantile(lower, interpolation="linear").over(by),
+        expression.quantile(upper, interpolation="linear").over(by),
+    )
+
+
+def neutralize(
+    values: pl.DataFrame,
+    factor_loadings: pl.DataFrame,
+    value: str,
+    by: str | list[str] = "date",
+    intercept: bool = True,
+) -> pl.DataFrame:
+    """
+    Replace value with the residual of a least squares regression on the factor
+    loadings (date, ticker, factor, loading) within each cross section.
+
+    The normal equations of every cross section are summed and solved as one
+    batch. Rows without a value or a full set of loadings are left out of the
+    fit and get a null residual, as does every row of a cross section with
+    fewer observations than parameters or a singular fit.
+    """
+    by = [by] if isinstance(by, str) else by
+
+    loadings = factor_loadings.pivot(
+        on="factor", index=["date", "ticker"], values="loading", sort_columns=True
+    )
+    factors = [
+        column for column in loadings.columns if column not in ("date", "ticker")
+    ]
+
+    values = values.join(
+        loadings, on=["date", "ticker"], how="left", maintain_order="left"
+    ).sort(by)
+
+    y = values[value].cast(pl.Float64).fill_null(np.nan).to_numpy()
+    X = (
+        values.select(factors)
+        .cast(pl.Float64)
+        .fill_null(np.nan)
+        .to_numpy()
+        .reshape(len(values), len(factors))
+    )
+    if intercept:
+        X = add_constant(X)
+
+    groups = values.select(pl.struct(by).rle_id()).to_series().to_numpy()
+    xtx, xty, _, count = group_sums(y, X, groups)
+    params = solve_windows(xtx, xty, count, np.ones(len(count), dtype=bool))
+
+    # Each row takes the parameters of its cross section
+    rows = np.repeat(params, np.diff(get_group_bounds(groups)), axis=0)
+    residuals = y - (X * rows).sum(axis=1)
+
+    return values.drop(factors).with_columns(
+        pl.Series(value, residuals, nan_to_null=True)
+    )
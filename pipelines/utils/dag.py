@@ -0,0 +1,142 @@
+import contextvars
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable
+
+import polars as pl
+
+# Stage name -> (callable, names of the stages it depends on)
+Stages = dict[str, tuple[Callable[[], object], list[str]]]
+
+
+def validate_stages(stages: Stages):
+    for name, (_, dependencies) in stages.items():
+        for dependency in dependencies:
+            if dependency not in stages:
+                raise ValueError(
+                    f"Stage '{name}' depends on unknown stage '{dependency}'"
+                )
+
+    # Kahn's algorithm: every stage must eventually become ready
+    remaining = {name: set(dependencies) for name, (_, dependencies) in stages.items()}
+    while remaining:
+        ready = [name for name, dependencies in remaining.items() if not dependencies]
+        if not ready:
+            raise ValueError(f"Stages have a dependency cycle: {sorted(remaining)}")
+
+        for name in ready:
+            del remaining[name]
+        for dependencies in remaining.values():
+            dependencies.difference_update(ready)
+
+
+def get_critical_path(
+    stages: Stages, timings: dict[str, tuple[float, float]]
+) -> list[str]:
+    # Walk back from the last stage to finish through whichever dependency
+    # finished last, i.e. the one that actually held it up
+    name = max(timings, key=lambda stage: timings[stage][1])
+    critical_path = [name]
+    while True:
+        dependencies = [
+            dependency for dependency in stages[name][1] if dependency in timings
+        ]
+        if not dependencies:
+            break
+
+        name = max(dependencies, key=lambda stage: timings[stage][1])
+        critical_path.append(name)
+
+    return critical_path[::-1]
+
+
+def run_stages(stages: Stages, max_workers: int = 4) -> pl.DataFrame:
+    """
+    Run every stage as soon as all of its dependencies have finished, with up to
+    max_workers stages at once. If a stage fails no new stages are started, the
+    running ones are allowed to finish and the first error is raised.
+
+    Prints and returns each stage's start and finish (seconds from the start of
+    the run) and whether it is on the critical path.
+    """
+    validate_stages(stages)
+
+    remaining = {name: set(dependencies) for name, (_, dependencies) in stages.items()}
+    timings = {}
+    running = {}
+    error = None
+    run_start = time.perf_counter()
+
+    def run_stage(name: str):
+        start = time.perf_counter() - run_start
+        stages[name][0]()
+        return start, time.perf_counter() - run_start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while remaining or running:
+            if error is None:
+                ready = [
+                    name for name, dependencies in remaining.items() if not dependencies
+                ]
+                for name in ready:
+                    del remaining[name]
+
+                    # Run in a copy of the caller's context so stages still see
+                    # it (e.g. the parent flow run)
+                    context = contextvars.copy_context()
+                    running[executor.submit(context.run, run_stage, name)] = name
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+
+                try:
+                    timings[name] = future.result()
+                except Exception as exception:
+                    error = error or exception
+                    continue
+
+                for dependencies in remaining.values():
+                    dependencies.discard(name)
+
+    if timings:
+        critical_path = get_critical_path(stages, timings)
+        report = pl.DataFrame(
+            [
+                {
+                    "stage": name,
+                    "start": start,
+                    "finish": finish,
+                    "duration": finish - start,
+                    "critical": name in critical_path,
+                }
+                for name, (start, finish) in sorted(
+                    timings.items(), key=lambda item: item[1][0]
+                )
+            ]
+        )
+
+        print(report)
+        print("Critical path:", " -> ".join(critical_path))
+        print(
+            f"Wall clock: {time.perf_counter() - run_start:.1f}s, "
+            f"sum of stages: {report['duration'].sum():.1f}s"
+        )
+    else:
+        report = pl.DataFrame(
+            schema={
+                "stage": pl.String,
+                "start": pl.Float64,
+                "finish": pl.Float64,
+                "duration": pl.Float64,
+                "critical": pl.Boolean,
+            }
+        )
+
+    if error is not None:
+        raise error
+
+    return report
@@ -1,29 +1,176 @@
 import datetime as dt
 
-import bear_lake as bl
 import polars as pl
 from clients import get_bear_lake_client
 from prefect import task
 
+from .benchmark import get_benchmark
+from .datasets import get_dataset
 
-@task
-def get_universe(start: dt.date, end: dt.date) -> pl.DataFrame:
+
+def get_date_partitions(name: str, start: dt.date, end: dt.date) -> list[str] | None:
+    # Only tables partitioned by year can be pruned from a date range
     bear_lake_client = get_bear_lake_client()
-    return bear_lake_client.query(
-        bl.table("universe")
+    if bear_lake_client.get_partition_keys(name) != ["year"]:
+        return None
+
+    return [str(year) for year in range(start.year, end.year + 1)]
+
+
+def scan_table(
+    name: str, start: dt.date, end: dt.date, columns: list[str]
+) -> pl.LazyFrame:
+    """
+    Scan only the year partitions overlapping [start, end], with the date
+    predicate and column selection applied before anything else (e.g. a join).
+    Reads from memory instead if an earlier stage of the run published the range.
+    """
+    dataset = get_dataset(name, start, end)
+    if dataset is not None:
+        return dataset.lazy().select(columns)
+
+    bear_lake_client = get_bear_lake_client()
+    return (
+        bear_lake_client.table(name, get_date_partitions(name, start, end))
         .filter(pl.col("date").is_between(start, end))
+        .select(columns)
+    )
+
+
+def scan_universe_intervals(start: dt.date, end: dt.date) -> pl.LazyFrame:
+    # Membership intervals overlapping [start, end], null bounds are open
+    bear_lake_client = get_bear_lake_client()
+    return (
+        bear_lake_client.table("universe_intervals")
+        .filter(
+            (pl.col("start_date").is_null() | (pl.col("start_date") <= end))
+            & (pl.col("end_date").is_null() | (pl.col("end_date") >= start))
+        )
+        .select("ticker", "start_date", "end_date")
+    )
+
+
+def expand_universe(
+    start: dt.date, end: dt.date, intervals: pl.LazyFrame | None = None
+) -> pl.LazyFrame:
+    """
+    (date, ticker) for every trading date in [start, end] on which the ticker
+    was a member, expanding the membership intervals over that range only.
+    """
+    if intervals is None:
+        intervals = scan_universe_intervals(start, end)
+
+    return (
+        intervals.select(
+            "ticker",
+            pl.date_ranges(
+                pl.max_horizontal("start_date", pl.lit(start)),
+                pl.min_horizontal("end_date", pl.lit(end)),
+            ).alias("date"),
+        )
+        .explode("date")
+        .join(scan_table("calendar", start, end, ["date"]), on="date", how="semi")
         .select("date", "ticker")
-        .sort("ticker", "date")
     )
 
 
+def join_universe(
+    name: str,
+    start: dt.date,
+    end: dt.date,
+    columns: list[str],
+    universe: pl.LazyFrame | None = None,
+) -> pl.LazyFrame:
+    # Every member on every date, with nulls where the table has no row
+    if universe is None:
+        universe = expand_universe(start, end)
+
+    return universe.join(
+        other=scan_table(name, start, end, ["date", "ticker", *columns]),
+        on=["date", "ticker"],
+        how="left",
+    )
+
+
+def filter_universe(
+    name: str,
+    start: dt.date,
+    end: dt.date,
+    columns: list[str],
+    intervals: pl.LazyFrame | None = None,
+) -> pl.LazyFrame:
+    """
+    Rows of the table inside one of their ticker's membership intervals. Same as
+    join_universe without the null rows, but joins the intervals directly
+    instead of an expanded universe.
+    """
+    if intervals is None:
+        intervals = scan_universe_intervals(start, end)
+
+    return (
+        scan_table(name, start, end, ["date", "ticker", *columns])
+        .join(intervals, on="ticker", how="inner")
+        .filter(
+            (pl.col("start_date").is_null() | (pl.col("date") >= pl.col("start_date")))
+            & (pl.col("end_date").is_null() | (pl.col("date") <= pl.col("end_date")))
+        )
+        .drop("start_date", "end_date")
+    )
+
+
+def scan_benchmark_weights(
+    start: dt.date,
+    end: dt.date,
+    benchmark: str = "equal_weight",
+    universe: pl.LazyFrame | None = None,
+    cached: bool = False,
+) -> pl.LazyFrame:
+    """
+    (date, ticker, weight) of the benchmark for every member on every date,
+    evaluated from its rule over the universe. With cached, reads the weights
+    materialized by the benchmark flow instead.
+    """
+    if universe is None:
+        universe = expand_universe(start, end)
+
+    if cached:
+        return join_universe("benchmark_weights", start, end, ["weight"], universe)
+
+    raw_weight, columns = get_benchmark(benchmark)
+    if columns:
+        universe = join_universe("stock_prices", start, end, columns, universe)
+
+    return universe.with_columns(raw_weight.cast(pl.Float64).alias("weight")).select(
+        "date",
+        "ticker",
+        pl.col("weight").truediv(pl.col("weight").sum().over("date")),
+    )
+
+
+def explain_scan(name: str, start: dt.date, end: dt.date) -> pl.DataFrame:
+    """Partitions and bytes a date range scan of the table would read."""
+    bear_lake_client = get_bear_lake_client()
+    scan_plan = bear_lake_client.get_scan_plan(
+        name, get_date_partitions(name, start, end)
+    )
+
+    print(scan_plan)
+    print(f"{name}: {len(scan_plan)} partitions, {scan_plan['bytes'].sum()} bytes")
+
+    return scan_plan
+
+
+@task
+def get_universe(start: dt.date, end: dt.date) -> pl.DataFrame:
+    bear_lake_client = get_bear_lake_client()
+    return bear_lake_client.query(expand_universe(start, end).sort("ticker", "date"))
+
+
 @task
 def get_universe_returns(start: dt.date, end: dt.date) -> pl.DataFrame:
     bear_lake_client = get_bear_lake_client()
     return bear_lake_client.query(
-        bl.table("universe")
-        .join(other=bl.table("stock_returns"), on=["date", "ticker"], how="left")
-        .filter(pl.col("date").is_between(start, end))
+        join_universe("stock_returns", start, end, ["return"])
         .select("date", "ticker", "return")
         .sort("ticker", "date")
     )
@@ -33,10 +180,9 @@ def get_universe_returns(start: dt.date, end: dt.date) -> pl.DataFrame:
 def get_stock_returns(start: dt.date, end: dt.date) -> pl.DataFrame:
     bear_lake_client = get_bear_lake_client()
     return bear_lake_client.query(
-        bl.table("stock_returns")
-        .filter(pl.col("date").is_between(start, end))
-        .select("date", "ticker", "return")
-        .sort("ticker", "date")
+        scan_table("stock_returns", start, end, ["date", "ticker", "return"]).sort(
+            "ticker", "date"
+        )
     )
 
 
@@ -44,10 +190,9 @@ def get_stock_returns(start: dt.date, end: dt.date) -> pl.DataFrame:
 def get_etf_returns(start: dt.date, end: dt.date) -> pl.DataFrame:
     bear_lake_client = get_bear_lake_client()
     return bear_lake_client.query(
-        bl.table("etf_returns")
-        .filter(pl.col("date").is_between(start, end))
-        .select("date", "ticker", "return")
-        .sort("ticker", "date")
+        scan_table("etf_returns", start, end, ["date", "ticker", "return"]).sort(
+            "ticker", "date"
+        )
     )
 
 
@@ -55,23 +200,25 @@ def get_etf_returns(start: dt.date, end: dt.date) -> pl.DataFrame:
 def get_alphas(start: dt.date, end: dt.date) -> pl.DataFrame:
     bear_lake_client = get_bear_lake_client()
     return bear_lake_client.query(
-        bl.table("universe")
-        .join(other=bl.table("alphas"), on=["date", "ticker"], how="left")
-        .filter(pl.col("date").is_between(start, end), pl.col("alpha").is_not_null())
+        filter_universe("alphas", start, end, ["alpha"])
+        .filter(pl.col("alpha").is_not_null())
         .select("date", "ticker", "alpha")
         .sort("ticker", "date")
     )
 
 
 @task
-def get_benchmark_weights(start: dt.date, end: dt.date) -> pl.DataFrame:
+def get_benchmark_weights(
+    start: dt.date,
+    end: dt.date,
+    benchmark: str = "equal_weight",
+    cached: bool = False,
+) -> pl.DataFrame:
     bear_lake_client = get_bear_lake_client()
     return bear_lake_client.query(
-        bl.table("universe")
-        .join(other=bl.table("benchmark_weights"), on=["date", "ticker"], how="left")
-        .filter(pl.col("date").is_between(start, end))
-        .select("date", "ticker", "weight")
-        .sort("ticker", "date")
+        scan_benchmark_weights(start, end, benchmark, cached=cached).sort(
+            "ticker", "date"
+        )
     )
 
 
@@ -80,7 +227,9 @@ def get_benchmark_returns(start: dt.date, end: dt.date) -> pl.DataFrame:
     bear_lake_client = get_bear_lake_client()
 
     return bear_lake_client.query(
-        bl.table("benchmark_returns").filter(pl.col("date").is_between(start, end))
+        bear_lake_client.table("benchmark_returns").filter(
+            pl.col("date").is_between(start, end)
+        )
     )
 
 
@@ -88,9 +237,8 @@ def get_benchmark_returns(start: dt.date, end: dt.date) -> pl.DataFrame:
 def get_factor_loadings(start: dt.date, end: dt.date) -> pl.DataFrame:
     bear_lake_client = get_bear_lake_client()
     return bear_lake_client.query(
-        bl.table("universe")
-        .join(other=bl.table("factor_loadings"), on=["date", "ticker"], how="left")
-        .filter(pl.col("date").is_between(start, end), pl.col("loading").is_not_null())
+        filter_universe("factor_loadings", start, end, ["factor", "loading"])
+        .filter(pl.col("loading").is_not_null())
         .select("date", "ticker", "factor", "loading")
         .sort("ticker", "date")
     )
@@ -100,10 +248,12 @@ def get_factor_loadings(start: dt.date, end: dt.date) -> pl.DataFrame:
 def get_factor_covariances(start: dt.date, end: dt.date) -> pl.DataFrame:
     bear_lake_client = get_bear_lake_client()
     return bear_lake_client.query(
-        bl.table("factor_covariances")
-        .filter(pl.col("date").is_between(start, end))
-        .select("date", "factor_1", "factor_2", "covariance")
-        .sort("date")
+        scan_table(
+            "factor_covariances",
+            start,
+            end,
+            ["date", "factor_1", "factor_2", "covariance"],
+        ).sort("date")
     )
 
 
@@ -111,9 +261,8 @@ def get_factor_covariances(start: dt.date, end: dt.date) -> pl.DataFrame:
 def get_idio_vol(start: dt.date, end: dt.date) -> pl.DataFrame:
     bear_lake_client = get_bear_lake_client()
     return bear_lake_client.query(
-        bl.table("universe")
-        .join(other=bl.table("idio_vol"), on=["date", "ticker"], how="left")
-        .filter(pl.col("date").is_between(start, end), pl.col("idio_vol").is_not_null())
+        filter_universe("idio_vol", start, end, ["idio_vol"])
+        .filter(pl.col("idio_vol").is_not_null())
         .select("date", "ticker", "idio_vol")
         .sort("ticker", "date")
     )
@@ -123,10 +272,22 @@ def get_idio_vol(start: dt.date, end: dt.date) -> pl.DataFrame:
 def get_portfolio_weights(start: dt.date, end: dt.date) -> pl.DataFrame:
     bear_lake_client = get_bear_lake_client()
     return bear_lake_client.query(
-        bl.table("portfolio_weights")
+        scan_table("portfolio_weights", start, end, ["date", "ticker", "weight"]).sort(
+            "ticker", "date"
+        )
+    )
+
+
+@task
+def get_portfolio_metrics(start: dt.date, end: dt.date) -> pl.DataFrame:
+    bear_lake_client = get_bear_lake_client()
+    return bear_lake_client.query(
+        bear_lake_client.table("portfolio_metrics")
+        # Dates are written as strings
+        .with_columns(pl.col("date").cast(pl.String).str.to_date())
         .filter(pl.col("date").is_between(start, end))
-        .select("date", "ticker", "weight")
-        .sort("ticker", "date")
+        .select("date", "lambda", "active_risk", "method")
+        .sort("date")
     )
 
 
@@ -134,9 +295,74 @@ def get_portfolio_weights(start: dt.date, end: dt.date) -> pl.DataFrame:
 def get_prices(start: dt.date, end: dt.date) -> pl.DataFrame:
     bear_lake_client = get_bear_lake_client()
     return bear_lake_client.query(
-        bl.table("universe")
-        .join(other=bl.table("stock_prices"), on=["date", "ticker"], how="left")
-        .filter(pl.col("date").is_between(start, end))
+        join_universe("stock_prices", start, end, ["close"])
         .select("date", "ticker", "close")
         .sort("ticker", "date")
     )
+
+
+@task
+def get_model_snapshot(
+    start: dt.date,
+    end: dt.date,
+    benchmark: str = "equal_weight",
+    cached_benchmark_weights: bool = False,
+) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    """
+    Alphas, benchmark weights, factor loadings, factor covariances and idio vol
+    for [start, end], reading the universe intervals once and collecting all five queries
+    concurrently.
+
+    The ticker-level frames are restricted to the (date, ticker) pairs that have
+    an alpha, factor loadings and an idio vol, so they share one ticker index.
+    """
+    bear_lake_client = get_bear_lake_client()
+    intervals = bear_lake_client.query(scan_universe_intervals(start, end)).lazy()
+
+    alphas, benchmark_weights, factor_loadings, factor_covariances, idio_vol = (
+        bear_lake_client.collect_all(
+            [
+                filter_universe("alphas", start, end, ["alpha"], intervals).filter(
+                    pl.col("alpha").is_not_null()
+                ),
+                scan_benchmark_weights(
+                    start,
+                    end,
+                    benchmark,
+                    expand_universe(start, end, intervals),
+                    cached_benchmark_weights,
+                ),
+                filter_universe(
+                    "factor_loadings", start, end, ["factor", "loading"], intervals
+                ).filter(pl.col("loading").is_not_null()),
+                scan_table(
+                    "factor_covariances",
+                    start,
+                    end,
+                    ["date", "factor_1", "factor_2", "covariance"],
+                ),
+                filter_universe("idio_vol", start, end, ["idio_vol"], intervals).filter(
+                    pl.col("idio_vol").is_not_null()
+                ),
+            ]
+        )
+    )
+
+    index = (
+        alphas.select("date", "ticker")
+        .join(
+            factor_loadings.select("date", "ticker"), on=["date", "ticker"], how="semi"
+        )
+        .join(idio_vol.select("date", "ticker"), on=["date", "ticker"], how="semi")
+    )
+
+    def align(df: pl.DataFrame) -> pl.DataFrame:
+        return df.join(index, on=["date", "ticker"], how="semi").sort("ticker", "date")
+
+    return (
+        align(alphas),
+        align(benchmark_weights),
+        align(factor_loadings),
+        factor_covariances.sort("date"),
+        align(idio_vol),
+    )
@@ -0,0 +1,73 @@
+import contextlib
+import datetime as dt
+import threading
+
+import polars as pl
+
+stats = {
+    "dataset_hits": 0,
+    "dataset_misses": 0,
+}
+
+_lock = threading.Lock()
+
+# Table name -> (first date, last date, frame) published during the current run,
+# or None outside of a run. Prefect runs tasks on its own threads, so this is
+# process state rather than a context variable.
+_datasets: dict[str, tuple[dt.date, dt.date, pl.DataFrame]] | None = None
+
+
+@contextlib.contextmanager
+def dataset_scope():
+    """
+    Keep the frames published inside the block in memory so later stages of the
+    same run can read them instead of going back to Bear Lake. Outside of a
+    scope publishing is a no-op, so standalone and backfill runs hold nothing.
+    """
+    global _datasets
+
+    with _lock:
+        _datasets = {}
+    try:
+        yield
+    finally:
+        with _lock:
+            _datasets = None
+
+
+def publish_dataset(
+    name: str,
+    data: pl.DataFrame,
+    start: dt.date = dt.date.min,
+    end: dt.date = dt.date.max,
+):
+    """
+    Publish a frame that was just written to a table. It must hold every row of
+    the table with a date in [start, end], exactly as stored.
+    """
+    with _lock:
+        if _datasets is not None:
+            _datasets[name] = (start, end, data)
+
+
+def get_dataset(name: str, start: dt.date, end: dt.date) -> pl.DataFrame | None:
+    """
+    The published rows of a table with a date in [start, end], or None if
+    nothing published in this run covers the whole range.
+    """
+    with _lock:
+        if _datasets is None:
+            return None
+
+        published = _datasets.get(name)
+        hit = published is not None and published[0] <= start and end <= published[1]
+        stats["dataset_hits" if hit else "dataset_misses"] += 1
+
+    if not hit:
+        return None
+
+    return published[2].filter(pl.col("date").is_between(start, end))
+
+
+def get_dataset_stats() -> dict[str, int]:
+    return dict(stats)
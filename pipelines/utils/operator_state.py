@@ -0,0 +1,337 @@
+import math
+
+import numpy as np
+import polars as pl
+from clients import get_bear_lake_client
+
+from .rolling_regression import get_group_bounds
+
+OPERATOR_STATE_SCHEMA = {
+    "table": pl.String,
+    "key": pl.String,
+    "date": pl.Date,
+    "ewm_mean": pl.Float64,
+    "ewm_weight": pl.Float64,
+    "buffer": pl.List(pl.Float64),
+}
+
+# Statistic of a full window of observations, NaN if any of them is missing
+ROLLING_OPERATORS = {
+    "sum": lambda buffer: buffer.sum(axis=1),
+    "std": lambda buffer: buffer.std(axis=1, ddof=1),
+}
+
+
+def get_empty_state() -> pl.DataFrame:
+    return pl.DataFrame(
+        schema={
+            name: dtype
+            for name, dtype in OPERATOR_STATE_SCHEMA.items()
+            if name != "table"
+        }
+    )
+
+
+def get_series_key(keys: list[str]) -> pl.Expr:
+    return pl.concat_str(keys, separator="|").alias("key")
+
+
+def get_ewm_decay(half_life: float) -> float:
+    # Weight kept by the previous observations, as in ewm_mean(half_life=...)
+    return math.exp(-math.log(2) / half_life)
+
+
+def apply_operators(
+    observations: pl.DataFrame,
+    keys: list[str],
+    value: str,
+    rolling: str | None = None,
+    window: int | None = None,
+    half_life: float | None = None,
+) -> pl.DataFrame:
+    """
+    Batch computation of the operators over each whole series: a rolling
+    statistic over the last window observations, then an EWM of the result.
+    """
+    expression = pl.col(value)
+
+    if rolling == "sum":
+        expression = expression.rolling_sum(window_size=window)
+    elif rolling == "std":
+        expression = expression.rolling_std(window_size=window)
+
+    if half_life is not None:
+        expression = expression.ewm_mean(half_life=half_life)
+
+    return observations.sort(*keys, "date").with_columns(expression.over(keys))
+
+
+def update_operator_state(
+    state: pl.DataFrame,
+    observations: pl.DataFrame,
+    keys: list[str],
+    value: str,
+    rolling: str | None = None,
+    window: int | None = None,
+    half_life: float | None = None,
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    Roll every series forward one observation at a time from its state, which
+    is O(1) per observation in the length of the history. Gives the same output
+    as apply_operators over the whole history.
+
+    Observations on or before a series' state date are skipped, so applying the
+    same day twice is a no-op. Returns the new state and the new observations
+    with the value replaced by the operator output.
+    """
+    observations = (
+        observations.with_columns(get_series_key(keys))
+        .join(
+            state.select("key", pl.col("date").alias("state_date")),
+            on="key",
+            how="left",
+        )
+        .filter(
+            pl.col("state_date").is_null() | (pl.col("date") > pl.col("state_date"))
+        )
+        .drop("state_date")
+        .sort("date", "key")
+    )
+
+    series = (
+        pl.concat([state.select("key"), observations.select("key")])
+        .unique()
+        .sort("key")
+        .join(state, on="key", how="left", maintain_order="left")
+    )
+    index = (
+        observations.select("key")
+        .join(series.select("key").with_row_index(), on="key", maintain_order="left")[
+            "index"
+        ]
+        .to_numpy()
+    )
+    values = observations[value].cast(pl.Float64).fill_null(np.nan).to_numpy()
+    outputs = np.full(len(observations), np.nan)
+
+    # EWM numerator and weight normalizer, zero for series without a state
+    weight = series["ewm_weight"].fill_null(0.0).to_numpy().copy()
+    total = series["ewm_mean"].fill_null(0.0).to_numpy() * weight
+
+    # Last window observations of every series, oldest first, NaN padded
+    if window is not None:
+        buffer = np.array(
+            [
+                row if row is not None else [np.nan] * window
+                for row in series["buffer"].to_list()
+            ],
+            dtype=np.float64,
+        ).reshape(len(series), window)
+
+    if half_life is not None:
+        decay = get_ewm_decay(half_life)
+
+    bounds = get_group_bounds(observations["date"].rle_id().to_numpy())
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        rows = index[start:end]
+        x = values[start:end]
+
+        if window is not None:
+            buffer[rows] = np.column_stack([buffer[rows, 1:], x])
+            x = ROLLING_OPERATORS[rolling](buffer[rows])
+
+        if half_life is not None:
+            # Missing observations still decay the earlier ones
+            observed = ~np.isnan(x)
+            total[rows] = decay * total[rows] + np.where(observed, x, 0.0)
+            weight[rows] = decay * weight[rows] + observed
+            with np.errstate(divide="ignore", invalid="ignore"):
+                x = np.where(observed, total[rows] / weight[rows], np.nan)
+
+        outputs[start:end] = x
+
+    # Series that never had an observation have a zero weight and no mean
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / weight
+
+    last_dates = observations.group_by("key").agg(pl.col("date").max())
+    state = series.select("key").with_columns(
+        series.select("key", "date")
+        .join(last_dates, on="key", how="left", suffix="_new", maintain_order="left")
+        .select(pl.coalesce("date_new", "date").alias("date"))
+        .to_series(),
+        (
+            pl.Series("ewm_mean", mean, nan_to_null=True)
+            if half_life is not None
+            else pl.lit(None, pl.Float64).alias("ewm_mean")
+        ),
+        (
+            pl.Series("ewm_weight", weight)
+            if half_life is not None
+            else pl.lit(None, pl.Float64).alias("ewm_weight")
+        ),
+        (
+            pl.Series("buffer", buffer.tolist(), dtype=pl.List(pl.Float64)).list.eval(
+                pl.element().fill_nan(None)
+            )
+            if window is not None
+            else pl.lit(None, pl.List(pl.Float64)).alias("buffer")
+        ),
+    )
+
+    outputs = observations.drop("key").with_columns(
+        pl.Series(value, outputs, nan_to_null=True)
+    )
+
+    return state, outputs
+
+
+def build_operator_state(
+    observations: pl.DataFrame,
+    keys: list[str],
+    value: str,
+    rolling: str | None = None,
+    window: int | None = None,
+    half_life: float | None = None,
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    # A full rebuild is an update of an empty state over the whole history
+    return update_operator_state(
+        get_empty_state(), observations, keys, value, rolling, window, half_life
+    )
+
+
+def check_operator_state(
+    state: pl.DataFrame,
+    observations: pl.DataFrame,
+    keys: list[str],
+    value: str,
+    rolling: str | None = None,
+    window: int | None = None,
+    half_life: float | None = None,
+    outputs: pl.DataFrame | None = None,
+    tolerance: float = 1e-6,
+):
+    """
+    Diff the carried state, and optionally outputs written by daily updates,
+    against the batch computation over the observations. EWMs can only be
+    checked over the whole history the state was built from, rolling windows
+    over anything longer than the window.
+    """
+    observations = observations.sort(*keys, "date")
+    batch = apply_operators(observations, keys, value, rolling, window, half_life)
+
+    # Series in the state without observations (e.g. delisted before the
+    # start of a shorter history) can't be checked and are left out
+    compared = (
+        batch.group_by(get_series_key(keys), maintain_order=True)
+        .agg(
+            # The EWM mean only changes on observed values
+            pl.col(value).drop_nulls().last().alias("batch_ewm_mean"),
+            pl.col("date").last().alias("batch_date"),
+        )
+        .join(state, on="key", how="left")
+    )
+    if window is not None:
+        compared = compared.join(
+            observations.group_by(get_series_key(keys), maintain_order=True).agg(
+                pl.col(value).tail(window).alias("batch_buffer")
+            ),
+            on="key",
+            how="left",
+        )
+
+    errors = {
+        "missing_series": compared.select(pl.col("date").is_null().sum()).item(),
+        "date_mismatches": compared.select(
+            (pl.col("date") != pl.col("batch_date")).sum()
+        ).item(),
+        "ewm_error": 0.0,
+        "buffer_error": 0.0,
+        "output_error": 0.0,
+    }
+
+    if half_life is not None:
+        errors["ewm_error"] = (
+            compared.select(
+                (pl.col("ewm_mean") - pl.col("batch_ewm_mean")).abs().max()
+            ).item()
+            or 0.0
+        )
+
+    if window is not None:
+        # The buffers are padded in front for series shorter than the window
+        for carried, recomputed in compared.select(
+            pl.col("buffer").list.tail(pl.col("batch_buffer").list.len()),
+            "batch_buffer",
+        ).iter_rows():
+            carried = np.array(carried or [], dtype=np.float64)
+            recomputed = np.array(recomputed or [], dtype=np.float64)
+
+            if carried.shape != recomputed.shape or not np.array_equal(
+                np.isnan(carried), np.isnan(recomputed)
+            ):
+                errors["buffer_error"] = np.inf
+                break
+
+            errors["buffer_error"] = max(
+                errors["buffer_error"],
+                float(
+                    np.abs(carried - recomputed).max(
+                        initial=0, where=~np.isnan(carried)
+                    )
+                ),
+            )
+
+    if outputs is not None:
+        errors["output_error"] = (
+            outputs.join(batch, on=[*keys, "date"], how="inner", suffix="_batch")
+            .select((pl.col(value) - pl.col(f"{value}_batch")).abs().max())
+            .item()
+            or 0.0
+        )
+
+    print("Operator state errors:", errors)
+
+    if (
+        errors["missing_series"] > 0
+        or errors["date_mismatches"] > 0
+        or max(errors["ewm_error"], errors["buffer_error"], errors["output_error"])
+        > tolerance
+    ):
+        raise ValueError(
+            "Operator state has drifted from the batch computation! "
+            "Run the backfill flow to rebuild it."
+        )
+
+
+def get_operator_state(table: str) -> pl.DataFrame:
+    bear_lake_client = get_bear_lake_client()
+
+    if "operator_state" not in bear_lake_client.list_tables():
+        return get_empty_state()
+
+    return bear_lake_client.query(
+        bear_lake_client.table("operator_state", [table])
+        .filter(pl.col("table") == table)
+        .drop("table")
+        .sort("key")
+    )
+
+
+def upload_operator_state(table: str, state: pl.DataFrame):
+    bear_lake_client = get_bear_lake_client()
+
+    # Create table if not exists
+    bear_lake_client.create(
+        name="operator_state",
+        schema=OPERATOR_STATE_SCHEMA,
+        partition_keys=["table"],
+        primary_keys=["table", "key"],
+        mode="skip",
+    )
+
+    # Upsert data (only the partition of this table is rewritten)
+    bear_lake_client.upsert(
+        name="operator_state",
+        data=state.select(pl.lit(table).alias("table"), *state.columns),
+    )
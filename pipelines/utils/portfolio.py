@@ -1,19 +1,47 @@
+from functools import cache
+
 import cvxpy as cp
 import numpy as np
 import polars as pl
 
+from .covariance_matrix import FactorRiskModel, get_factor_covariance_root
 
-def solve_quadratic_problem(
-    n_assets: int,
-    alphas: np.ndarray,
-    covariance_matrix: np.ndarray,
-    lambda_: float,
-):
+
+def get_risk_model_arrays(
+    covariance_matrix: pl.DataFrame | FactorRiskModel,
+) -> np.ndarray | FactorRiskModel:
+    if isinstance(covariance_matrix, pl.DataFrame):
+        return covariance_matrix.drop("ticker").to_numpy()
+    return covariance_matrix
+
+
+def get_factor_form(
+    covariance_matrix: np.ndarray | FactorRiskModel,
+) -> FactorRiskModel:
+    if isinstance(covariance_matrix, tuple):
+        return covariance_matrix
+
+    # A dense covariance matrix is just a factor model with N factors
+    return get_factor_covariance_root(covariance_matrix).T, np.zeros(
+        len(covariance_matrix)
+    )
+
+
+@cache
+def get_quadratic_problem(
+    n_assets: int, n_factors: int
+) -> tuple[cp.Problem, cp.Variable, cp.Parameter, cp.Parameter, cp.Parameter]:
+    # Built once per universe shape so cvxpy only canonicalizes it once. The risk
+    # parameters carry sqrt(lambda) so lambda never multiplies a parameter
     weights = cp.Variable(n_assets)
+    alphas = cp.Parameter(n_assets)
+    factor_exposures = cp.Parameter((n_factors, n_assets))
+    idio_vol = cp.Parameter(n_assets, nonneg=True)
 
     objective = cp.Maximize(
         cp.matmul(weights, alphas)
-        - 0.5 * lambda_ * cp.quad_form(weights, covariance_matrix)
+        - 0.5 * cp.sum_squares(factor_exposures @ weights)
+        - 0.5 * cp.sum_squares(cp.multiply(idio_vol, weights))
     )
 
     constraints = [
@@ -22,23 +50,147 @@ def solve_quadratic_problem(
     ]
 
     problem = cp.Problem(objective, constraints)
+
+    return problem, weights, alphas, factor_exposures, idio_vol
+
+
+def get_variance(
+    weights: np.ndarray, covariance_matrix: np.ndarray | FactorRiskModel
+) -> float:
+    if isinstance(covariance_matrix, tuple):
+        factor_exposures, idio_vol = covariance_matrix
+        return np.sum((factor_exposures @ weights) ** 2) + np.sum(
+            (idio_vol * weights) ** 2
+        )
+    return weights @ covariance_matrix @ weights.T
+
+
+@cache
+def get_risk_target_problem(n_assets: int, n_factors: int) -> tuple:
+    # Benchmark exposures are parameters of their own so the problem stays DPP
+    weights = cp.Variable(n_assets)
+    alphas = cp.Parameter(n_assets)
+    factor_exposures = cp.Parameter((n_factors, n_assets))
+    idio_vol = cp.Parameter(n_assets, nonneg=True)
+    benchmark_factor_exposures = cp.Parameter(n_factors)
+    benchmark_idio_exposures = cp.Parameter(n_assets)
+    max_active_risk = cp.Parameter(nonneg=True)
+
+    active_risk = cp.norm(
+        cp.hstack(
+            [
+                factor_exposures @ weights - benchmark_factor_exposures,
+                cp.multiply(idio_vol, weights) - benchmark_idio_exposures,
+            ]
+        )
+    )
+    risk_constraint = active_risk <= max_active_risk
+
+    constraints = [
+        cp.sum(weights) == 1,  # Full investment
+        weights >= 0,  # Long only
+        risk_constraint,  # Active risk target
+    ]
+
+    problem = cp.Problem(cp.Maximize(cp.matmul(weights, alphas)), constraints)
+
+    parameters = (
+        alphas,
+        factor_exposures,
+        idio_vol,
+        benchmark_factor_exposures,
+        benchmark_idio_exposures,
+        max_active_risk,
+    )
+
+    return problem, weights, parameters, risk_constraint, active_risk
+
+
+def solve_risk_target_problem(
+    n_assets: int,
+    alphas: np.ndarray,
+    covariance_matrix: np.ndarray | FactorRiskModel,
+    benchmark_weights: np.ndarray,
+    max_active_risk: float,
+) -> tuple[np.ndarray | None, float | None]:
+    factor_exposures, idio_vol = get_factor_form(covariance_matrix)
+
+    problem, weights, parameters, risk_constraint, active_risk = (
+        get_risk_target_problem(n_assets, len(factor_exposures))
+    )
+
+    values = (
+        alphas,
+        factor_exposures,
+        idio_vol,
+        factor_exposures @ benchmark_weights,
+        idio_vol * benchmark_weights,
+        max_active_risk,
+    )
+    for parameter, value in zip(parameters, values):
+        parameter.value = value
+
     problem.solve()
 
+    if problem.status not in cp.settings.SOLUTION_PRESENT:
+        return None, None
+
+    # A slack constraint's multiplier is zero up to solver noise, so there is no
+    # lambda to report when the alphas don't use up the risk budget
+    if active_risk.value < 0.999 * max_active_risk:
+        return weights.value, None
+
+    # The risk constraint's multiplier is the lambda of the equivalent mean-variance
+    # problem max αᵀw - ½λ (w - b)ᵀ Σ (w - b), scaled by the active risk
+    lambda_ = float(risk_constraint.dual_value) / max_active_risk
+
+    return weights.value, lambda_ if lambda_ > 0 else None
+
+
+def solve_quadratic_problem(
+    n_assets: int,
+    alphas: np.ndarray,
+    covariance_matrix: np.ndarray | FactorRiskModel,
+    lambda_: float,
+    initial_weights: np.ndarray | None = None,
+):
+    if lambda_ <= 0:
+        raise ValueError(f"Lambda must be positive, got {lambda_}")
+
+    factor_exposures, idio_vol = get_factor_form(covariance_matrix)
+
+    problem, weights, alphas_param, factor_exposures_param, idio_vol_param = (
+        get_quadratic_problem(n_assets, len(factor_exposures))
+    )
+
+    # ½λ‖Bw‖² = ½‖√λ Bw‖², which leaves the objective at its original scale
+    alphas_param.value = alphas
+    factor_exposures_param.value = np.sqrt(lambda_) * factor_exposures
+    idio_vol_param.value = np.sqrt(lambda_) * idio_vol
+
+    # Otherwise the warm start is the last solution for this shape
+    if initial_weights is not None:
+        weights.value = initial_weights
+
+    problem.solve(warm_start=True)
+
     return weights.value
 
 
 def get_optimal_weights(
     alphas: pl.DataFrame,
-    covariance_matrix: pl.DataFrame,
+    covariance_matrix: pl.DataFrame | FactorRiskModel,
     lambda_: float,
+    initial_weights: np.ndarray | None = None,
 ) -> pl.DataFrame:
     tickers = alphas["ticker"].sort().to_list()
 
     optimal_weights = solve_quadratic_problem(
         n_assets=len(tickers),
         alphas=alphas["alpha"].to_numpy(),
-        covariance_matrix=covariance_matrix.drop("ticker").to_numpy(),
+        covariance_matrix=get_risk_model_arrays(covariance_matrix),
         lambda_=lambda_,
+        initial_weights=initial_weights,
     )
 
     return pl.DataFrame({"ticker": tickers, "weight": optimal_weights})
@@ -79,20 +231,78 @@ def get_active_weights(
 
 
 def get_active_risk(
-    active_weights: pl.DataFrame, covariance_matrix: pl.DataFrame
+    active_weights: pl.DataFrame, covariance_matrix: pl.DataFrame | FactorRiskModel
 ) -> float:
     active_weights = active_weights.sort("ticker")["active_weight"].to_numpy()
-    covariance_matrix = covariance_matrix.drop("ticker").to_numpy()
+    covariance_matrix = get_risk_model_arrays(covariance_matrix)
+
+    return np.sqrt(get_variance(active_weights, covariance_matrix)) * np.sqrt(252)
+
+
+def get_optimal_weights_risk_target(
+    alphas: pl.DataFrame,
+    covariance_matrix: pl.DataFrame | FactorRiskModel,
+    benchmark_weights: pl.DataFrame,
+    target_active_risk: float = 0.05,
+) -> tuple[pl.DataFrame, float | None, float] | None:
+    tickers = alphas["ticker"].sort().to_list()
 
-    return np.sqrt(active_weights @ covariance_matrix @ active_weights.T) * np.sqrt(252)
+    benchmark_weights_vector = (
+        alphas.select("ticker")
+        .sort("ticker")
+        .join(benchmark_weights.select("ticker", "weight"), on="ticker", how="left")[
+            "weight"
+        ]
+        .fill_null(0)
+        .to_numpy()
+    )
+
+    optimal_weights, lambda_ = solve_risk_target_problem(
+        n_assets=len(tickers),
+        alphas=alphas["alpha"].to_numpy(),
+        covariance_matrix=get_risk_model_arrays(covariance_matrix),
+        benchmark_weights=benchmark_weights_vector,
+        max_active_risk=target_active_risk / np.sqrt(252),
+    )
+
+    if optimal_weights is None:
+        return None
+
+    optimal_weights = pl.DataFrame({"ticker": tickers, "weight": optimal_weights})
+
+    active_weights = get_active_weights(optimal_weights, benchmark_weights)
+    active_risk = get_active_risk(active_weights, covariance_matrix)
+
+    return optimal_weights, lambda_, active_risk
 
 
 def get_optimal_weights_dynamic(
     alphas: pl.DataFrame,
-    covariance_matrix: pl.DataFrame,
+    covariance_matrix: pl.DataFrame | FactorRiskModel,
     benchmark_weights: pl.DataFrame,
     target_active_risk: float = 0.05,
-) -> tuple[pl.DataFrame, float, float]:
+    initial_lambda: float | None = None,
+    initial_weights: pl.DataFrame | None = None,
+    method: str = "risk_target",
+) -> tuple[pl.DataFrame, float | None, float, str]:
+    # Also returns the method that produced the weights, since the lambda of the
+    # risk target (active risk) and of the search (total risk) mean different things
+    if method == "risk_target":
+        result = get_optimal_weights_risk_target(
+            alphas, covariance_matrix, benchmark_weights, target_active_risk
+        )
+
+        if result is not None:
+            return *result, "risk_target"
+
+        # The target is out of reach (e.g. the benchmark isn't investable within
+        # the alpha universe), so fall back to getting as close as possible
+        print("Active risk target is infeasible, falling back to lambda search!")
+    elif method != "lambda_search":
+        raise ValueError(
+            f"Invalid method: '{method}'. Must be 'risk_target' or 'lambda_search'"
+        )
+
     active_risk = float("inf")
     lambda_ = None
     error = 0.005
@@ -100,13 +310,28 @@ def get_optimal_weights_dynamic(
     iterations = 1
     data = []
 
+    # Seed the first solve with the previous date's weights
+    if initial_weights is not None:
+        initial_weights = (
+            alphas.select("ticker")
+            .sort("ticker")
+            .join(initial_weights.select("ticker", "weight"), on="ticker", how="left")[
+                "weight"
+            ]
+            .fill_null(0)
+            .to_numpy()
+        )
+
     while abs(active_risk - target_active_risk) > error:
         if lambda_ is None:
-            lambda_ = 100
+            lambda_ = initial_lambda if initial_lambda is not None else 100
         else:
             lambda_ = predict_lambda(data, target_active_risk)
 
-        optimal_weights = get_optimal_weights(alphas, covariance_matrix, lambda_)
+        optimal_weights = get_optimal_weights(
+            alphas, covariance_matrix, lambda_, initial_weights
+        )
+        initial_weights = None
 
         active_weights = get_active_weights(optimal_weights, benchmark_weights)
         active_risk = get_active_risk(active_weights, covariance_matrix)
@@ -118,4 +343,4 @@ def get_optimal_weights_dynamic(
         else:
             iterations += 1
 
-    return optimal_weights, lambda_, active_risk
+    return optimal_weights, lambda_, active_risk, "lambda_search"
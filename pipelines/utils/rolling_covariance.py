@@ -0,0 +1,72 @@
+import numpy as np
+
+BLOCK_SIZE = 32
+
+
+def rolling_sum(values: np.ndarray, window: int) -> np.ndarray:
+    cumulative = np.cumsum(values, axis=0)
+    cumulative[window:] = cumulative[window:] - cumulative[:-window]
+    return cumulative
+
+
+def rolling_block_covariances(
+    X_i: np.ndarray,
+    present_i: np.ndarray,
+    X_j: np.ndarray,
+    present_j: np.ndarray,
+    window: int,
+) -> np.ndarray:
+    """
+    Trailing window covariances between every column of X_i and every column of
+    X_j from windowed sums of outer products. Missing values must be zeroed, so
+    each pair only sums the rows where both columns are present.
+    """
+    xy = rolling_sum(X_i[:, :, None] * X_j[:, None, :], window)
+    x = rolling_sum(X_i[:, :, None] * present_j[:, None, :], window)
+    y = rolling_sum(present_i[:, :, None] * X_j[:, None, :], window)
+    count = rolling_sum(present_i[:, :, None] * present_j[:, None, :], window)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covariances = (xy - x * y / count) / (count - 1)
+
+    return np.where(count >= window, covariances, np.nan)
+
+
+def rolling_covariances(returns: np.ndarray, window: int) -> np.ndarray:
+    """
+    Rolling covariance matrices of the columns of a (T, K) array of returns
+    sorted by date, as a (T, K, K) array.
+
+    Each pair of columns uses the rows in the trailing window where both are
+    present, which matches pandas' rolling(window, min_periods=window).cov(),
+    and is NaN until the window has that many such rows.
+    """
+    present = ~np.isnan(returns)
+
+    # Centering leaves the covariances unchanged but keeps the running sums of
+    # products small, so subtracting them loses less precision
+    count = np.maximum(present.sum(axis=0), 1)
+    means = np.where(present, returns, 0.0).sum(axis=0) / count
+    X = np.where(present, returns - means, 0.0)
+    present = present.astype(np.float64)
+
+    # Blocks of columns keep the stacked outer products small in memory for a
+    # large number of factors, and the lower blocks are mirrored from the upper
+    K = returns.shape[1]
+    covariances = np.empty((len(returns), K, K))
+    for i in range(0, K, BLOCK_SIZE):
+        for j in range(i, K, BLOCK_SIZE):
+            columns_i = slice(i, i + BLOCK_SIZE)
+            columns_j = slice(j, j + BLOCK_SIZE)
+
+            block = rolling_block_covariances(
+                X[:, columns_i],
+                present[:, columns_i],
+                X[:, columns_j],
+                present[:, columns_j],
+                window,
+            )
+            covariances[:, columns_i, columns_j] = block
+            covariances[:, columns_j, columns_i] = block.transpose(0, 2, 1)
+
+    return covariances
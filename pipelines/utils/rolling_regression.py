@@ -0,0 +1,159 @@
+import numpy as np
+
+CHUNK_SIZE = 64
+
+
+def add_constant(X: np.ndarray) -> np.ndarray:
+    return np.column_stack([np.ones(len(X)), X])
+
+
+def get_missing_mask(y: np.ndarray, X: np.ndarray) -> np.ndarray:
+    return np.isnan(y) | np.isnan(X).any(axis=1)
+
+
+def zero_missing(
+    y: np.ndarray, X: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    missing = get_missing_mask(y, X)
+    y = np.where(missing, 0.0, y)
+    X = np.where(missing[:, None], 0.0, X)
+    return y, X, missing
+
+
+def get_group_bounds(groups: np.ndarray) -> np.ndarray:
+    # Rows are sorted by group, so each group is a contiguous block
+    breaks = np.flatnonzero(groups[1:] != groups[:-1]) + 1
+    return np.concatenate([[0], breaks, [len(groups)]])
+
+
+def get_group_positions(groups: np.ndarray) -> np.ndarray:
+    bounds = get_group_bounds(groups)
+    starts = np.repeat(bounds[:-1], np.diff(bounds))
+    return np.arange(len(groups)) - starts
+
+
+def windowed_sums(
+    y: np.ndarray, X: np.ndarray, window: int
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Trailing window sums of XᵀX, Xᵀy, yᵀy and the observation count for a single
+    contiguous block of rows. Missing rows contribute nothing to any of the sums.
+    """
+    y, X, missing = zero_missing(y, X)
+
+    def rolling_sum(values: np.ndarray) -> np.ndarray:
+        cumulative = np.cumsum(values, axis=0)
+        cumulative[window:] = cumulative[window:] - cumulative[:-window]
+        return cumulative
+
+    xtx = rolling_sum(X[:, :, None] * X[:, None, :])
+    xty = rolling_sum(X * y[:, None])
+    yty = rolling_sum(y**2)
+    count = rolling_sum((~missing).astype(np.int64))
+
+    return xtx, xty, yty, count
+
+
+def group_sums(
+    y: np.ndarray, X: np.ndarray, groups: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sums of XᵀX, Xᵀy, yᵀy and the observation count over each group of rows,
+    skipping missing rows. Rows must be sorted by group.
+    """
+    y, X, missing = zero_missing(y, X)
+
+    starts = get_group_bounds(groups)[:-1]
+
+    xtx = np.add.reduceat(X[:, :, None] * X[:, None, :], starts, axis=0)
+    xty = np.add.reduceat(X * y[:, None], starts, axis=0)
+    yty = np.add.reduceat(y**2, starts)
+    count = np.add.reduceat((~missing).astype(np.int64), starts)
+
+    return xtx, xty, yty, count
+
+
+def update_windowed_sums(
+    xtx: np.ndarray,
+    xty: np.ndarray,
+    yty: np.ndarray,
+    count: np.ndarray,
+    y_old: np.ndarray,
+    X_old: np.ndarray,
+    y_new: np.ndarray,
+    X_new: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Roll one window per group forward by a single row: remove the oldest
+    observation and add the newest. Pass NaN for the oldest observation of
+    groups whose window is not full yet so nothing is removed.
+    """
+    y_old, X_old, old_missing = zero_missing(y_old, X_old)
+    y_new, X_new, new_missing = zero_missing(y_new, X_new)
+
+    xtx = (
+        xtx
+        - X_old[:, :, None] * X_old[:, None, :]
+        + X_new[:, :, None] * X_new[:, None, :]
+    )
+    xty = xty - X_old * y_old[:, None] + X_new * y_new[:, None]
+    yty = yty - y_old**2 + y_new**2
+    count = count - (~old_missing) + (~new_missing)
+
+    return xtx, xty, yty, count
+
+
+def solve_windows(
+    xtx: np.ndarray, xty: np.ndarray, count: np.ndarray, full: np.ndarray
+) -> np.ndarray:
+    """
+    Solve the normal equations of every window that is full and has at least
+    as many observations as parameters. Everything else is NaN.
+    """
+    params = np.full(xty.shape, np.nan)
+    valid = full & (count >= xty.shape[1])
+    params[valid] = solve_normal_equations(xtx[valid], xty[valid])
+    return params
+
+
+def solve_normal_equations(xtx: np.ndarray, xty: np.ndarray) -> np.ndarray:
+    try:
+        return np.linalg.solve(xtx, xty[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        # Fall back to row by row so one singular window doesn't sink the batch
+        params = np.full(xty.shape, np.nan)
+        for i in range(len(xtx)):
+            try:
+                params[i] = np.linalg.solve(xtx[i], xty[i])
+            except np.linalg.LinAlgError:
+                continue
+        return params
+
+
+def rolling_ols(
+    y: np.ndarray, X: np.ndarray, groups: np.ndarray, window: int
+) -> np.ndarray:
+    """
+    Rolling OLS of y on [1, X] for every group at once.
+
+    Rows must be sorted by group and then by date. Windows are positional within
+    each group and rows with a missing y or X are dropped from the window, which
+    matches statsmodels' RollingOLS(missing="drop"). Returns an (n, K + 1) array
+    of [alpha, *betas] that is NaN wherever the window is incomplete, has fewer
+    than K + 1 observations, or is singular.
+    """
+    X = add_constant(X)
+    params = np.full(X.shape, np.nan)
+
+    bounds = get_group_bounds(groups)
+    positions = get_group_positions(groups)
+
+    # Chunk by group so the stacked cross products stay small in memory
+    chunk_bounds = np.append(bounds[:-1:CHUNK_SIZE], bounds[-1])
+    for chunk_start, chunk_end in zip(chunk_bounds[:-1], chunk_bounds[1:]):
+        rows = slice(chunk_start, chunk_end)
+        xtx, xty, _, count = windowed_sums(y[rows], X[rows], window)
+
+        params[rows] = solve_windows(xtx, xty, count, positions[rows] >= window - 1)
+
+    return params
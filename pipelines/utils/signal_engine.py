@@ -0,0 +1,127 @@
+import time
+
+import polars as pl
+from clients import get_bear_lake_client
+
+from .cross_section import cross_sectional_zscore, neutralize, winsorize
+
+# (expression over the shared inputs, evaluated per ticker in date order;
+#  trading days of history it needs to produce a value on the last date)
+Signal = tuple[pl.Expr, int]
+
+SIGNALS: dict[str, Signal] = {}
+
+
+def register_signal(name: str, expression: pl.Expr, lookback: int):
+    if name in SIGNALS:
+        raise ValueError(f"Signal '{name}' is already registered")
+
+    SIGNALS[name] = (expression, lookback)
+
+
+def get_signal_lookback(signals: dict[str, Signal] | None = None) -> int:
+    signals = SIGNALS if signals is None else signals
+    return max(lookback for _, lookback in signals.values())
+
+
+def compute_signals(
+    inputs: pl.LazyFrame,
+    ic: float,
+    signals: dict[str, Signal] | None = None,
+    profile: bool = False,
+    factor_loadings: pl.LazyFrame | None = None,
+) -> pl.DataFrame:
+    """
+    Evaluate every signal, its cross-sectional score and its alpha in a single
+    lazy query over the shared inputs (ticker, date, idio_vol and whatever
+    columns the signals use), so the inputs are scanned once and the signals
+    are evaluated together in one with_columns. With profile, the inputs are
+    collected first and each signal is also timed on its own over them.
+
+    Scores are the winsorized values, neutralized against the factor loadings
+    (date, ticker, factor, loading) if given, as z-scores within each date.
+    Values without a full set of loadings get a null score and alpha.
+
+    Returns (ticker, date, year, signal, value, score, alpha).
+    """
+    signals = SIGNALS if signals is None else signals
+    bear_lake_client = get_bear_lake_client()
+
+    if profile:
+        inputs = bear_lake_client.query(inputs)
+        profile_signals(inputs, signals)
+        inputs = inputs.lazy()
+
+    query = (
+        inputs.sort("ticker", "date")
+        .with_columns(
+            expression.over("ticker").alias(name)
+            for name, (expression, _) in signals.items()
+        )
+        .unpivot(
+            on=list(signals),
+            index=["ticker", "date", "idio_vol"],
+            variable_name="signal",
+            value_name="value",
+        )
+        .drop_nulls("value")
+        .with_columns(winsorize(pl.col("value"), by=["date", "signal"]).alias("score"))
+    )
+
+    start = time.perf_counter()
+
+    if factor_loadings is None:
+        results = bear_lake_client.query(query)
+    else:
+        # Collected together so a shared scan (e.g. the universe) is read once
+        results, factor_loadings = bear_lake_client.collect_all(
+            [query, factor_loadings]
+        )
+        results = neutralize(results, factor_loadings, "score", by=["date", "signal"])
+
+    results = (
+        results.with_columns(
+            cross_sectional_zscore(pl.col("score"), by=["date", "signal"])
+        )
+        .select(
+            "ticker",
+            "date",
+            pl.col("date").dt.year().alias("year"),
+            "signal",
+            "value",
+            "score",
+            pl.lit(ic).mul(pl.col("score")).mul(pl.col("idio_vol")).alias("alpha"),
+        )
+        .sort("signal", "ticker", "date")
+    )
+
+    print(f"Computed {len(signals)} signals in {time.perf_counter() - start:.2f}s")
+
+    return results
+
+
+def profile_signals(
+    inputs: pl.DataFrame, signals: dict[str, Signal] | None = None
+) -> pl.DataFrame:
+    """
+    Time each signal on its own over inputs that are already in memory, so
+    only the signal itself is measured.
+    """
+    signals = SIGNALS if signals is None else signals
+    inputs = inputs.sort("ticker", "date")
+
+    timings = []
+    for name, (expression, lookback) in signals.items():
+        start = time.perf_counter()
+        inputs.lazy().select(expression.over("ticker").alias(name)).collect()
+        seconds = time.perf_counter() - start
+
+        timings.append({"signal": name, "lookback": lookback, "seconds": seconds})
+
+    timings = pl.DataFrame(
+        timings,
+        schema={"signal": pl.String, "lookback": pl.Int64, "seconds": pl.Float64},
+    )
+    print(timings)
+
+    return timings
@@ -6,3 +6,10 @@ DISABLE_TQDM = False
 IC = 0.05
 TIME_ZONE = ZoneInfo("UTC")
 TARGET_ACTIVE_RISK = 0.05
+RISK_MODEL = "factor"
+OPTIMIZER = "risk_target"
+BENCHMARK = "equal_weight"
+CACHE_BENCHMARK_WEIGHTS = False
+PROFILE_SIGNALS = True
+RESTATEMENT_WINDOW_DAYS = 10
+NEUTRALIZE_SIGNALS = True